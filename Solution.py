@@ -1,6 +1,18 @@
-from typing import List, Tuple
+from typing import List, Tuple, Dict
 from psycopg2 import sql
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from collections import OrderedDict, deque
+from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import io
+import inspect
+import uuid
+import select
+import time
+import math
+import logging
 import Utility.DBConnector as Connector
 from Utility.ReturnValue import ReturnValue
 from Utility.Exceptions import DatabaseException
@@ -9,24 +21,971 @@ from Business.Order import Order, BadOrder
 from Business.Dish import Dish, BadDish
 from Business.OrderDish import OrderDish
 from decimal import Decimal
+from fractions import Fraction
+
+_log = logging.getLogger(__name__)
+
+
+# ---------------------------------- QUERY CACHE: ----------------------------------
+# results of the analytical queries are cached per (function, arguments) and tagged with the change counters
+# of the tables they read. the write APIs bump the counters of the tables they touch, and the change listener
+# bumps them for the writes of every other node and for the triggers' cascades. the cache is therefore used
+# only while a listener is running on every database - before start_change_listener() or while one of the
+# listeners is reconnecting the queries always run, since the counters cannot see the changes made elsewhere.
+
+QUERY_CACHE_MAX_ENTRIES = 256
+
+_ALL_TABLES = ('CUSTOMERS', 'ORDERS', 'DISHES', 'CUSTOMERS_PLACE_ORDERS', 'DISHES_IN_ORDERS', 'CUSTOMERS_LIKE_DISHES')
+
+_cache_lock = threading.RLock()
+_cache_context = threading.local()
+_table_versions = {}
+_query_cache = OrderedDict()
+_query_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bypasses': 0}
+
+
+def _bump_table_versions(*tables: str) -> None:
+    with _cache_lock:
+        for table in tables:
+            _table_versions[table] = _table_versions.get(table, 0) + 1
+
+
+def _query_failed(result=None):
+    # the cached functions swallow database errors and return a fallback result, which must not be cached
+    _cache_context.failed = True
+    return result
+
+
+def _cached_query(*tables: str):
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key = (func.__name__, arguments.args)
+            if not _change_feed_live():
+                # without the change feed of every database a cached entry may miss the changes of other nodes
+                with _cache_lock:
+                    _query_cache_stats['bypasses'] += 1
+                return func(*args, **kwargs)
+            with _cache_lock:
+                # the versions are read before running the query, so a write racing with it only makes the entry stale
+                versions = tuple(_table_versions.get(table, 0) for table in tables)
+                entry = _query_cache.get(key)
+                if entry is not None and entry[0] == versions:
+                    _query_cache.move_to_end(key)
+                    _query_cache_stats['hits'] += 1
+                    return list(entry[1]) if isinstance(entry[1], list) else entry[1]
+                _query_cache_stats['misses'] += 1
+            previous, _cache_context.failed = getattr(_cache_context, 'failed', False), False
+            try:
+                result = func(*args, **kwargs)
+                failed = _cache_context.failed
+            finally:
+                _cache_context.failed = previous
+            if failed:
+                return result
+            with _cache_lock:
+                _query_cache[key] = (versions, list(result) if isinstance(result, list) else result)
+                _query_cache.move_to_end(key)
+                while len(_query_cache) > QUERY_CACHE_MAX_ENTRIES:
+                    _query_cache.popitem(last=False)
+                    _query_cache_stats['evictions'] += 1
+            return result
+        return wrapper
+    return decorator
+
+
+def get_query_cache_stats() -> Dict[str, float]:
+    with _cache_lock:
+        lookups = _query_cache_stats['hits'] + _query_cache_stats['misses']
+        return {'hits': _query_cache_stats['hits'],
+                'misses': _query_cache_stats['misses'],
+                'evictions': _query_cache_stats['evictions'],
+                'bypasses': _query_cache_stats['bypasses'],
+                'entries': len(_query_cache),
+                'hit_rate': _query_cache_stats['hits'] / lookups if lookups else 0.0}
+
+
+def clear_query_cache() -> None:
+    with _cache_lock:
+        _query_cache.clear()
+        for stat in _query_cache_stats:
+            _query_cache_stats[stat] = 0
+
+
+# ---------------------------------- SHARDING: ----------------------------------
+# configure_shards() spreads the data over several databases. CUSTOMERS, CUSTOMERS_LIKE_DISHES and the placed
+# orders (ORDERS, CUSTOMERS_PLACE_ORDERS, DISHES_IN_ORDERS) live on the shard of their customer, an anonymous
+# order lives on the shard of its order_id until it is placed, and the DISHES menu is replicated to every shard.
+# the API functions run unchanged against a single shard - _new_connection() connects to the shard selected
+# for the current thread - and their routers decide where they run and merge the results of global queries.
+#
+# the writes to the replicated menu run as one two-phase transaction over every shard (the shard databases need
+# max_prepared_transactions > 0): the write runs on every shard, and only if all of them succeed it is prepared
+# and then committed, shard 0 first in both steps. a write left prepared by a crash or an unreachable shard
+# holds the locks of its dish until recover_replicated_writes() ends it - committed where shard 0 committed it,
+# rolled back everywhere while it is still prepared on shard 0. moving an order to the shard of its customer
+# (customer_placed_order) is not atomic: it is copied first and deleted from its old shard after, so a failure
+# in between leaves the order on both shards. a transaction that notified cannot be prepared, so the change feed
+# triggers stay silent in the replicated writes and the menu change is announced once it is committed.
+
+_REPLICATED_WRITE_PREFIX = 'replicated-write-'
+
+_shard_factories = []
+_shard_context = threading.local()
+
+
+def configure_shards(connector_factories: List) -> None:
+    # every factory is a callable returning a new DBConnector-compatible connection to one shard database
+    global _shard_factories
+    _shard_factories = list(connector_factories)
+
+
+def clear_shards() -> None:
+    configure_shards([])
+
+
+def _new_connection():
+    factory = getattr(_shard_context, 'factory', None) or Connector.DBConnector
+    call = getattr(_parallel_local, 'call', None)
+    if call is not None and call.cancelled:
+        raise DatabaseException.ConnectionInvalid("the call was cancelled")
+    conn = _profiled_connect(factory) if _profiler is not None else factory()
+    if call is not None:
+        # run_parallel cancels the query of a call that timed out or was cancelled
+        call.opened(conn)
+    return conn
+
+
+def _run_with_factory(name: str, factory, func, *args):
+    previous = getattr(_shard_context, 'factory', None)
+    _shard_context.factory = factory
+    try:
+        return _profile_call(name, func, *args)
+    finally:
+        _shard_context.factory = previous
+
+
+def _run_on_shard(shard: int, func, *args):
+    return _run_with_factory("shard[{}]".format(shard), _shard_factories[shard], func, *args)
+
+
+def _run_on_all_shards(func, *args) -> List:
+    return run_parallel([(_run_on_shard, shard, func) + args for shard in range(len(_shard_factories))])
+
+
+def _run_outside_shards(func, *args):
+    # the decorated functions called by func are routed again, as if the application called them
+    previous = getattr(_shard_context, 'factory', None)
+    _shard_context.factory = None
+    try:
+        return func(*args)
+    finally:
+        _shard_context.factory = previous
+
+
+def _shard_of(key: int) -> int:
+    # invalid keys go to the first shard, which rejects them like the unsharded database would
+    return key % len(_shard_factories) if isinstance(key, int) else 0
+
+
+def _execute(query) -> int:
+    conn = None
+    try:
+        conn = _new_connection()
+        rows_effected, _ = conn.execute(query)
+        return rows_effected
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def _fetch_rows(query) -> List[tuple]:
+    conn = None
+    try:
+        conn = _new_connection()
+        _, res = conn.execute(query)
+        return res.rows
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def _gather_from_all_shards(func, *args) -> List:
+    results = _run_on_all_shards(func, *args)
+    if any(_call_failed(rows) for rows in results):
+        raise ConnectionError("a shard did not answer")
+    return [row for rows in results for row in rows]
+
+
+def _sum_by_key(rows: List[tuple]) -> Dict:
+    totals = {}
+    for key, value in rows:
+        totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _literal_list(values: List) -> sql.Composed:
+    return sql.SQL(", ").join(sql.Literal(value) for value in values)
+
+
+def _sharded(router):
+    # calls made inside a shard (by a router) run as they are, so routers can call the decorated function itself
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _shard_factories or getattr(_shard_context, 'factory', None) is not None:
+                return func(*args, **kwargs)
+            # routers get every argument positionally, defaults included
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            return router(func, *arguments.args)
+        return wrapper
+    return decorator
+
+
+def _route_to_all_shards(func, *args):
+    results = _run_on_all_shards(func, *args)
+    # the replicas answer the same unless one of them failed
+    if any(_call_failed(result) for result in results) or any(result != results[0] for result in results):
+        return ReturnValue.ERROR
+    return results[0]
+
+
+class _PreparedConnection:
+    # the connection of one shard in a replicated write. the router ends its transaction together with the
+    # transactions of the other shards, so closing it is left to the router
+    def __init__(self, conn):
+        object.__setattr__(self, '_conn', conn)
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+
+def _shard_gid(gid: str, shard: int) -> str:
+    # the shards may share a PostgreSQL cluster, where the transaction identifiers have to be unique
+    return "{}.{}".format(gid, shard)
+
+
+def _begin_on_shard(shard: int, gid: str, opened: Dict, func, *args):
+    def factory():
+        conn = _shard_factories[shard]()
+        opened[shard] = conn
+        conn.connection.autocommit = False
+        conn.connection.tpc_begin(_shard_gid(gid, shard))
+        conn.execute("SET LOCAL solution.defer_notify = 'on'")
+        return _PreparedConnection(conn)
+    return _run_with_factory("shard[{}]".format(shard), factory, func, *args)
+
+
+def _end_prepared_writes(gids: List[str], commit: bool) -> None:
+    conn = None
+    try:
+        conn = _new_connection()
+        for gid in gids:
+            if commit:
+                conn.connection.tpc_commit(gid)
+            else:
+                conn.connection.tpc_rollback(gid)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def _announce_menu_change() -> None:
+    _run_on_all_shards(_execute, sql.SQL("SELECT pg_notify({}, 'DISHES')").format(sql.Literal(CHANGE_CHANNEL)))
+
+
+def _close_quietly(conn) -> None:
+    # closing a connection with an open transaction rolls it back
+    try:
+        conn.close()
+    except Exception as e:
+        pass
+    try:
+        conn.connection.close()
+    except Exception as e:
+        pass
+
+
+def _route_replicated_write(func, *args):
+    gid = _REPLICATED_WRITE_PREFIX + uuid.uuid4().hex
+    shards = range(len(_shard_factories))
+    opened = {}
+    results = run_parallel([(_begin_on_shard, shard, gid, opened, func) + args for shard in shards])
+    try:
+        if len(opened) != len(shards) or any(_call_failed(result) for result in results) or \
+                any(result != results[0] for result in results):
+            # the replicas reject a write alike, unless one of them failed
+            return ReturnValue.ERROR
+        if results[0] != ReturnValue.OK:
+            return results[0]
+        prepared = []
+        try:
+            for shard in shards:
+                opened[shard].connection.tpc_prepare()
+                prepared.append(shard)
+        except Exception as e:
+            # shard 0 is rolled back last, so a write still prepared there is known to be undecided
+            for shard in reversed(prepared):
+                opened[shard].connection.tpc_rollback()
+            return ReturnValue.ERROR
+        try:
+            opened[0].connection.tpc_commit()
+        except Exception as e:
+            # undecided: recover_replicated_writes() commits or rolls it back from the state of shard 0
+            return ReturnValue.ERROR
+        for shard in shards[1:]:
+            try:
+                opened[shard].connection.tpc_commit()
+            except Exception as e:
+                # the write is decided, so it is committed again from a new connection
+                try:
+                    _run_on_shard(shard, _end_prepared_writes, [_shard_gid(gid, shard)], True)
+                except Exception as e:
+                    pass
+        _bump_table_versions('DISHES')
+        _announce_menu_change()
+        return ReturnValue.OK
+    except Exception as e:
+        return ReturnValue.ERROR
+    finally:
+        for conn in opened.values():
+            _close_quietly(conn)
+
+
+def _prepared_writes(shard: int) -> Dict:
+    suffix = _shard_gid('', shard)
+    conn = None
+    try:
+        conn = _new_connection()
+        return {xid.gtrid[:-len(suffix)]: xid.prepared for xid in conn.connection.tpc_recover()
+                if xid.gtrid.startswith(_REPLICATED_WRITE_PREFIX) and xid.gtrid.endswith(suffix)}
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def recover_replicated_writes(min_age: float = 60.0) -> ReturnValue:
+    # ends the replicated writes that are prepared for at least min_age seconds, so the writes still in flight
+    # are left alone
+    if not _shard_factories:
+        return ReturnValue.OK
+    try:
+        prepared = [_run_on_shard(shard, _prepared_writes, shard) for shard in range(len(_shard_factories))]
+        # shard 0 is handled last: while a write is prepared there it is undecided everywhere
+        for shard in reversed(range(len(_shard_factories))):
+            stale = [gid for gid, prepared_at in prepared[shard].items()
+                     if (datetime.now(prepared_at.tzinfo) - prepared_at).total_seconds() >= min_age]
+            decided = [gid for gid in stale if shard != 0 and gid not in prepared[0]]
+            undecided = [gid for gid in stale if gid not in decided]
+            if decided:
+                _run_on_shard(shard, _end_prepared_writes, [_shard_gid(gid, shard) for gid in decided], True)
+            if undecided:
+                _run_on_shard(shard, _end_prepared_writes, [_shard_gid(gid, shard) for gid in undecided], False)
+        _bump_table_versions('DISHES')
+        _announce_menu_change()
+    except Exception as e:
+        return ReturnValue.ERROR
+    return ReturnValue.OK
+
+
+def _route_by_customer(func, cust_id: int, *args):
+    return _run_on_shard(_shard_of(cust_id), func, cust_id, *args)
+
+
+def _route_by_customer_object(func, customer: Customer):
+    return _run_on_shard(_shard_of(customer.get_cust_id()), func, customer)
+
+
+def _route_by_dish(func, dish_id: int, *args):
+    # the menu is replicated, so the reads are spread over the replicas
+    return _run_on_shard(_shard_of(dish_id), func, dish_id, *args)
+
+
+def _order_exists(order_id: int) -> bool:
+    return bool(_fetch_rows(sql.SQL("SELECT 1 FROM ORDERS WHERE order_id = {}").format(sql.Literal(order_id))))
+
+
+def _find_order_shard(order_id: int):
+    found = _run_on_all_shards(_order_exists, order_id)
+    if any(_call_failed(result) for result in found):
+        raise ConnectionError("a shard did not answer")
+    return found.index(True) if True in found else None
+
+
+def _unreachable_shard():
+    raise DatabaseException.ConnectionInvalid("the shard of the order could not be found")
+
+
+def _route_by_order(func, order_id: int, *args):
+    try:
+        shard = _find_order_shard(order_id)
+    except Exception as e:
+        # the function answers as it does when its database is unreachable (ERROR, or None for the reads)
+        return _run_with_factory("shard[?]", _unreachable_shard, func, order_id, *args)
+    # an unknown order is looked up on its own shard, which answers like the unsharded database would
+    return _run_on_shard(shard if shard is not None else _shard_of(order_id), func, order_id, *args)
+
+
+def _route_add_order(func, order: Order):
+    try:
+        if _find_order_shard(order.get_order_id()) is not None:
+            return ReturnValue.ALREADY_EXISTS
+    except Exception as e:
+        return ReturnValue.ERROR
+    return _run_on_shard(_shard_of(order.get_order_id()), func, order)
+
+
+def _route_customer_placed_order(func, customer_id: int, order_id: int):
+    try:
+        order_shard = _find_order_shard(order_id)
+    except Exception as e:
+        return ReturnValue.ERROR
+    customer_shard = _shard_of(customer_id)
+    if order_shard is None or order_shard == customer_shard:
+        return _run_on_shard(customer_shard, func, customer_id, order_id)
+    # the order (with its dishes) moves to the shard of its customer and is placed there
+    try:
+        order_rows = _run_on_shard(order_shard, _fetch_rows, sql.SQL(
+            "SELECT O.date, CPO.cust_id FROM ORDERS O "
+            "LEFT OUTER JOIN CUSTOMERS_PLACE_ORDERS CPO ON O.order_id = CPO.order_id "
+            "WHERE O.order_id = {id}").format(id=sql.Literal(order_id)))
+        if not order_rows:
+            return ReturnValue.NOT_EXISTS
+        order_date, placed_by = order_rows[0]
+        if placed_by is not None:
+            return ReturnValue.ALREADY_EXISTS
+        if not _run_on_shard(customer_shard, _fetch_rows, sql.SQL(
+                "SELECT 1 FROM CUSTOMERS WHERE cust_id = {id}").format(id=sql.Literal(customer_id))):
+            return ReturnValue.NOT_EXISTS
+        order_lines = _run_on_shard(order_shard, _fetch_rows, sql.SQL(
+            "SELECT dish_id, amount, price FROM DISHES_IN_ORDERS WHERE order_id = {id}").format(
+            id=sql.Literal(order_id)))
+        statements = [sql.SQL("INSERT INTO ORDERS(order_id, date) VALUES({}, {});").format(
+            sql.Literal(order_id), sql.Literal(order_date))]
+        if order_lines:
+            statements.append(sql.SQL("INSERT INTO DISHES_IN_ORDERS(order_id, dish_id, amount, price) "
+                                      "VALUES {};").format(
+                sql.SQL(", ").join(sql.SQL("({}, {}, {}, {})").format(sql.Literal(order_id), sql.Literal(dish_id),
+                                                                      sql.Literal(amount), sql.Literal(price))
+                                   for dish_id, amount, price in order_lines)))
+        statements.append(sql.SQL("INSERT INTO CUSTOMERS_PLACE_ORDERS(order_id, cust_id) VALUES({}, {});").format(
+            sql.Literal(order_id), sql.Literal(customer_id)))
+        _run_on_shard(customer_shard, _execute, sql.SQL(" ").join(statements))
+        # the order lives on, so its deletion from the old shard is not logged for the exports
+        _run_on_shard(order_shard, _execute, sql.SQL("SELECT set_config('solution.order_moved', 'on', true); "
+                                                     "DELETE FROM ORDERS WHERE order_id = {id}").format(
+            id=sql.Literal(order_id)))
+        _bump_table_versions('ORDERS', 'CUSTOMERS_PLACE_ORDERS', 'DISHES_IN_ORDERS')
+    except Exception as e:
+        return ReturnValue.ERROR
+    return ReturnValue.OK
+
+
+def _route_likes_events(func, events: List[Tuple[int, int, bool]]):
+    positions = {}
+    for index, (cust_id, _, _) in enumerate(events):
+        positions.setdefault(_shard_of(cust_id), []).append(index)
+    shards = list(positions)
+    results = run_parallel([(_run_on_shard, shard, func, [events[index] for index in positions[shard]])
+                            for shard in shards])
+    outcomes = [None] * len(events)
+    for shard, shard_outcomes in zip(shards, results):
+        for position, index in enumerate(positions[shard]):
+            outcomes[index] = shard_outcomes[position] if not _call_failed(shard_outcomes) \
+                else events[index] + (ReturnValue.ERROR,)
+    return outcomes
+
+
+def _route_by_customer_list(func, cust_ids: List[int]):
+    by_shard = {}
+    for cust_id in cust_ids:
+        by_shard.setdefault(_shard_of(cust_id), []).append(cust_id)
+    results = run_parallel([(_run_on_shard, shard, func, shard_cust_ids) for shard, shard_cust_ids in by_shard.items()])
+    if any(_call_failed(rows) for rows in results):
+        raise ConnectionError("a shard did not answer")
+    return [row for rows in results for row in rows]
+
+
+def _customer_liked_dishes(cust_id: int) -> List[int]:
+    return [row[0] for row in _run_on_shard(_shard_of(cust_id), _fetch_rows, sql.SQL(
+        "SELECT dish_id FROM CUSTOMERS_LIKE_DISHES WHERE cust_id = {id}").format(id=sql.Literal(cust_id)))]
+
+
+def _route_similar_customers(func, cust_id: int, min_shared: int, limit: int):
+    try:
+        liked = _customer_liked_dishes(cust_id)
+        if not liked:
+            return []
+        rows = _gather_from_all_shards(_fetch_rows, sql.SQL(
+            "SELECT cust_id, COUNT(*) FROM CUSTOMERS_LIKE_DISHES "
+            "WHERE dish_id IN ({liked}) AND cust_id != {id} "
+            "GROUP BY cust_id HAVING COUNT(*) >= {min_shared}").format(liked=_literal_list(liked),
+                                                                        id=sql.Literal(cust_id),
+                                                                        min_shared=sql.Literal(min_shared)))
+        return sorted(rows, key=lambda row: (-row[1], row[0]))[:limit]
+    except Exception as e:
+        return []
+
+
+def _route_ranked_recommendations(func, cust_id: int, k: int, min_shared: int, weight_by_purchases: bool):
+    try:
+        liked = _customer_liked_dishes(cust_id)
+        if not liked:
+            return []
+        # the likes of a similar customer are all on its own shard, so the per-shard counts add up
+        likers = _sum_by_key(_gather_from_all_shards(_fetch_rows, sql.SQL(
+            "SELECT CLD.dish_id, COUNT(*) FROM CUSTOMERS_LIKE_DISHES CLD "
+            "WHERE CLD.cust_id IN (SELECT cust_id FROM CUSTOMERS_LIKE_DISHES "
+            "WHERE dish_id IN ({liked}) AND cust_id != {id} "
+            "GROUP BY cust_id HAVING COUNT(*) >= {min_shared}) "
+            "AND CLD.dish_id NOT IN ({liked}) "
+            "GROUP BY CLD.dish_id").format(liked=_literal_list(liked), id=sql.Literal(cust_id),
+                                           min_shared=sql.Literal(min_shared))))
+        if not likers:
+            return []
+        purchased = {}
+        if weight_by_purchases:
+            purchased = _sum_by_key(_gather_from_all_shards(_fetch_rows, sql.SQL(
+                "SELECT dish_id, SUM(amount) FROM SALES_PER_HOUR WHERE dish_id IN ({dishes}) "
+                "GROUP BY dish_id").format(dishes=_literal_list(list(likers)))))
+        score = {dish_id: _recommendation_score(count, purchased.get(dish_id, 0), weight_by_purchases)
+                 for dish_id, count in likers.items()}
+        return sorted(score, key=lambda dish_id: (-score[dish_id], dish_id))[:k]
+    except Exception as e:
+        return []
+
+
+def _route_copy(func, file, query, binary: bool, header: bool):
+    # binary COPY streams carry their own header and trailer, so only csv streams can be concatenated
+    if binary:
+        raise ValueError("binary exports are not supported over shards")
+    for shard in range(len(_shard_factories)):
+        _run_on_shard(shard, func, file, query, binary, header and shard == 0)
+
+
+def _route_most_expensive_anonymous_order(func):
+    try:
+        rows = _gather_from_all_shards(_fetch_rows, sql.SQL(
+            "SELECT O.order_id, O.date, COALESCE(SUM(DIO.price * DIO.amount), 0.0) AS total_price "
+            "FROM ORDERS O "
+            "LEFT OUTER JOIN DISHES_IN_ORDERS DIO ON O.order_id = DIO.order_id "
+            "WHERE O.order_id NOT IN (SELECT CPO.order_id FROM CUSTOMERS_PLACE_ORDERS CPO) "
+            "GROUP BY O.order_id, O.date "
+            "ORDER BY total_price DESC, O.order_id ASC LIMIT 1"))
+        order_id, order_date, _ = min(rows, key=lambda row: (-row[2], row[0]))
+        return Order(order_id, order_date)
+    except Exception as e:
+        pass
+
+
+def _route_most_liked_dish_equal_to_most_purchased(func):
+    try:
+        likes = _sum_by_key(_gather_from_all_shards(_fetch_rows, sql.SQL(
+            "SELECT dish_id, amount_likes FROM MOST_LIKED_DISH_VIEW")))
+        purchases = _sum_by_key(_gather_from_all_shards(_fetch_rows, sql.SQL(
+            "SELECT dish_id, purchased_amount FROM MOST_PURCHASED_DISH_VIEW")))
+        if not likes or not purchases:
+            return False
+        top_liked = min(likes, key=lambda dish_id: (-likes[dish_id], dish_id))
+        top_purchased = min(purchases, key=lambda dish_id: (-purchases[dish_id], dish_id))
+        return top_liked == top_purchased
+    except Exception as e:
+        return _query_failed(False)
+
+
+def _route_customers_ordered_top_5_dishes(func):
+    try:
+        likes = _sum_by_key(_gather_from_all_shards(_fetch_rows, sql.SQL(
+            "SELECT dish_id, amount_likes FROM MOST_LIKED_DISHES_RANKING_VIEW")))
+        top_dishes = sorted(likes, key=lambda dish_id: (-likes[dish_id], dish_id))[:5]
+        if len(top_dishes) < 5:
+            return []
+        rows = _gather_from_all_shards(_fetch_rows, sql.SQL(
+            "SELECT CPO.cust_id "
+            "FROM CUSTOMERS_PLACE_ORDERS CPO "
+            "INNER JOIN DISHES_IN_ORDERS DIO ON CPO.order_id = DIO.order_id "
+            "WHERE DIO.dish_id IN ({dishes}) "
+            "GROUP BY CPO.cust_id "
+            "HAVING COUNT(DISTINCT DIO.dish_id) = 5").format(dishes=_literal_list(top_dishes)))
+        return sorted(row[0] for row in rows)
+    except Exception as e:
+        return _query_failed([])
+
+
+def _route_non_worth_price_increase(func):
+    try:
+        ordered = {}
+        for dish_id, price, amount, lines in _gather_from_all_shards(_fetch_rows, sql.SQL(
+                "SELECT dish_id, price, SUM(amount), COUNT(*) FROM DISHES_IN_ORDERS GROUP BY dish_id, price")):
+            total_amount, total_lines = ordered.get((dish_id, price), (0, 0))
+            ordered[(dish_id, price)] = (total_amount + amount, total_lines + lines)
+        # price * AVG(amount) of ORDERED_DISHES_PROFIT_VIEW, computed exactly over the lines of all shards
+        average_profit = {key: Fraction(key[1]) * Fraction(amount, lines) for key, (amount, lines) in ordered.items()}
+        current_price = dict(_run_on_shard(0, _fetch_rows, sql.SQL(
+            "SELECT dish_id, price FROM DISHES WHERE is_active = TRUE")))
+        return sorted({dish_id for (dish_id, price), profit in average_profit.items()
+                       if (dish_id, current_price.get(dish_id)) in average_profit
+                       and profit > average_profit[(dish_id, current_price[dish_id])]
+                       and price < current_price[dish_id]})
+    except Exception as e:
+        return []
+
+
+def _route_total_profit_per_month(func, year: int):
+    results = _run_on_all_shards(func, year)
+    if any(_call_failed(result) or not result for result in results):
+        return _query_failed([])
+    profit_per_month = OrderedDict()
+    for result in results:
+        for month, profit in result:
+            profit_per_month[month] = profit_per_month.get(month, 0.0) + profit
+    return list(profit_per_month.items())
+
+
+def _route_potential_dish_recommendations(func, cust_id: int):
+    try:
+        liked = [row[0] for row in _run_on_shard(_shard_of(cust_id), _fetch_rows, sql.SQL(
+            "SELECT dish_id FROM CUSTOMERS_LIKE_DISHES WHERE cust_id = {id}").format(id=sql.Literal(cust_id)))]
+        if len(liked) < 3:
+            return []
+        rows = _gather_from_all_shards(_fetch_rows, sql.SQL(
+            "SELECT DISTINCT CLD.dish_id "
+            "FROM CUSTOMERS_LIKE_DISHES CLD "
+            "WHERE CLD.cust_id IN (SELECT cust_id FROM CUSTOMERS_LIKE_DISHES "
+            "WHERE dish_id IN ({liked}) AND cust_id != {id} "
+            "GROUP BY cust_id HAVING COUNT(DISTINCT dish_id) >= 3) "
+            "AND CLD.dish_id NOT IN ({liked})").format(liked=_literal_list(liked), id=sql.Literal(cust_id)))
+        return sorted({row[0] for row in rows})
+    except Exception as e:
+        return []
+
+
+# ---------------------------------- PROFILER: ----------------------------------
+# profile_queries() times every API call made while it is active and splits it into phases: connect (opening and
+# closing connections), build (python work before the first query, mostly composing the SQL), execute (the query
+# round trips, server execution included), transfer (turning the received rows into a result set) and objects
+# (python work after the first query, mostly building Customer / Dish / ... objects). the calls a router makes on
+# every shard, and the calls of run_parallel, are nested frames of the call that made them, which spends the
+# time it is blocked on them in the wait phase.
+
+PROFILE_PHASES = ('connect', 'build', 'execute', 'transfer', 'objects', 'wait')
+
+_profiler = None
+_profile_local = threading.local()
+
+
+class _ProfileFrame:
+    def __init__(self, stack: tuple):
+        self.stack = stack
+        self.phases = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.round_trips = 0
+        self.rows = 0
+        self.self_phase = 'build'
+        self.resumed = time.perf_counter()
+
+    # the time between resume() and pause() is python work of the frame itself
+    def pause(self) -> float:
+        now = time.perf_counter()
+        self.phases[self.self_phase] += now - self.resumed
+        return now
+
+    def resume(self) -> None:
+        self.resumed = time.perf_counter()
+
+
+class QueryProfile:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks = {}
+
+    def _record(self, frame: _ProfileFrame) -> None:
+        with self._lock:
+            calls, round_trips, rows, phases = self._stacks.get(frame.stack,
+                                                                (0, 0, 0, dict.fromkeys(PROFILE_PHASES, 0.0)))
+            for phase, seconds in frame.phases.items():
+                phases[phase] += seconds
+            self._stacks[frame.stack] = (calls + 1, round_trips + frame.round_trips, rows + frame.rows, phases)
+
+    def report(self) -> List[Tuple[str, int, int, int, Dict[str, float]]]:
+        # (call stack, calls, round trips, rows transferred, seconds per phase), most expensive first
+        with self._lock:
+            stacks = [(';'.join(stack), calls, round_trips, rows, dict(phases))
+                      for stack, (calls, round_trips, rows, phases) in self._stacks.items()]
+        return sorted(stacks, key=lambda entry: -sum(entry[4].values()))
+
+    def phase_totals(self) -> Dict[str, float]:
+        totals = dict.fromkeys(PROFILE_PHASES, 0.0)
+        for _, _, _, _, phases in self.report():
+            for phase, seconds in phases.items():
+                totals[phase] += seconds
+        return totals
+
+    def dump_folded(self, file) -> None:
+        # one 'frame;frame;phase microseconds' line per stack and phase, as read by flamegraph.pl and speedscope
+        for stack, _, _, _, phases in self.report():
+            for phase, seconds in phases.items():
+                if seconds > 0:
+                    file.write("{};{} {}\n".format(stack, phase, int(seconds * 1000000)))
+
+
+@contextmanager
+def profile_queries():
+    global _profiler
+    profile = QueryProfile()
+    previous, _profiler = _profiler, profile
+    try:
+        yield profile
+    finally:
+        _profiler = previous
+
+
+def _profile_frames() -> List[_ProfileFrame]:
+    if not hasattr(_profile_local, 'frames'):
+        _profile_local.frames = []
+    return _profile_local.frames
+
+
+def _profile_stack() -> tuple:
+    frames = _profile_frames()
+    return frames[-1].stack if frames else getattr(_profile_local, 'base', ())
+
+
+def _current_profile_frame():
+    frames = _profile_frames()
+    return frames[-1] if frames else None
+
+
+def _profile_call(name: str, func, *args, **kwargs):
+    profile = _profiler
+    if profile is None:
+        return func(*args, **kwargs)
+    frames = _profile_frames()
+    if frames:
+        frames[-1].pause()
+    frame = _ProfileFrame(_profile_stack() + (name,))
+    frames.append(frame)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        frame.pause()
+        frames.pop()
+        profile._record(frame)
+        if frames:
+            frames[-1].resume()
+
+
+def _profiled(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return _profile_call(func.__name__, func, *args, **kwargs)
+    return wrapper
+
+
+class _ProfiledCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.execute_time = 0.0
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(*args, **kwargs)
+        finally:
+            self.execute_time += time.perf_counter() - start
+
+    def copy_expert(self, query, file, *args, **kwargs):
+        # COPY streams the rows into the file without going through the connector, so its round trip is
+        # accounted here: writing the file is the transfer, the rest is the server
+        frame = _current_profile_frame()
+        if frame is None:
+            return self._cursor.copy_expert(query, file, *args, **kwargs)
+        start = frame.pause()
+        # psycopg2 writes str into text files and bytes into the others, so the wrapper keeps the kind of file
+        timed_file = _TimedTextFile(file) if isinstance(file, io.TextIOBase) else _TimedFile(file)
+        try:
+            return self._cursor.copy_expert(query, timed_file, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            frame.phases['execute'] += elapsed - timed_file.write_time
+            frame.phases['transfer'] += timed_file.write_time
+            frame.round_trips += 1
+            frame.rows += max(self._cursor.rowcount, 0)
+            frame.self_phase = 'objects'
+            frame.resume()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _TimedFile:
+    def __init__(self, file):
+        self._file = file
+        self.write_time = 0.0
+
+    def write(self, data):
+        start = time.perf_counter()
+        try:
+            return self._file.write(data)
+        finally:
+            self.write_time += time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class _TimedTextFile(_TimedFile, io.TextIOBase):
+    pass
+
+
+class _ProfiledConnection:
+    # the connector runs the query on its cursor, which is swapped for a timed one to tell the round trip of the
+    # query apart from building the result set
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = None
+        if getattr(conn, 'cursor', None) is not None:
+            self._cursor = conn.cursor = _ProfiledCursor(conn.cursor)
+
+    def execute(self, query, *args, **kwargs):
+        frame = _current_profile_frame()
+        if frame is None:
+            return self._conn.execute(query, *args, **kwargs)
+        start = frame.pause()
+        executed_before = self._cursor.execute_time if self._cursor is not None else 0.0
+        try:
+            result = self._conn.execute(query, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            round_trip = self._cursor.execute_time - executed_before if self._cursor is not None else elapsed
+            frame.phases['execute'] += round_trip
+            frame.phases['transfer'] += elapsed - round_trip
+            frame.round_trips += 1
+            frame.self_phase = 'objects'
+            frame.resume()
+        rows = getattr(result[1], 'rows', None)
+        frame.rows += len(rows) if rows else 0
+        return result
+
+    def close(self):
+        frame = _current_profile_frame()
+        if frame is None:
+            return self._conn.close()
+        start = frame.pause()
+        try:
+            return self._conn.close()
+        finally:
+            frame.phases['connect'] += time.perf_counter() - start
+            frame.resume()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def _profiled_wait(func, *args):
+    frame = _current_profile_frame()
+    if frame is None:
+        return func(*args)
+    start = frame.pause()
+    try:
+        return func(*args)
+    finally:
+        frame.phases['wait'] += time.perf_counter() - start
+        frame.resume()
+
+
+def _profiled_connect(factory):
+    frame = _current_profile_frame()
+    if frame is None:
+        return factory()
+    start = frame.pause()
+    try:
+        return _ProfiledConnection(factory())
+    finally:
+        frame.phases['connect'] += time.perf_counter() - start
+        frame.resume()
 
 
 # ---------------------------------- CRUD API: ----------------------------------
 # Basic database functions
 
+# the btree indexes serve the prefix matches of the search, which are ranked first. pg_trgm may not be installable
+# by the application's role, in which case the substring matches are found without the trigram indexes and
+# SEARCH_SIMILARITY ranks the matches by how much of the text the query covers
+_PREFIX_SEARCH_SCHEMA = ("CREATE INDEX CUSTOMERS_FULL_NAME_PREFIX_IDX ON CUSTOMERS (LOWER(full_name) text_pattern_ops);"
+                         "CREATE INDEX CUSTOMERS_PHONE_PREFIX_IDX ON CUSTOMERS (phone text_pattern_ops);"
+                         "CREATE INDEX DISHES_NAME_PREFIX_IDX ON DISHES (LOWER(name) text_pattern_ops);")
+_TRIGRAM_SEARCH_SCHEMA = ("CREATE INDEX CUSTOMERS_FULL_NAME_TRGM_IDX ON CUSTOMERS USING GIN (full_name gin_trgm_ops);"
+                          "CREATE INDEX CUSTOMERS_PHONE_TRGM_IDX ON CUSTOMERS USING GIN (phone gin_trgm_ops);"
+                          "CREATE INDEX DISHES_NAME_TRGM_IDX ON DISHES USING GIN (name gin_trgm_ops);"
+                          ""
+                          "CREATE FUNCTION SEARCH_SIMILARITY(target TEXT, query TEXT) RETURNS REAL AS $$ "
+                          "SELECT similarity(target, query) "
+                          "$$ LANGUAGE SQL IMMUTABLE;")
+_PLAIN_SEARCH_SCHEMA = ("CREATE FUNCTION SEARCH_SIMILARITY(target TEXT, query TEXT) RETURNS REAL AS $$ "
+                        "SELECT LENGTH(query)::REAL / GREATEST(LENGTH(target), LENGTH(query), 1) "
+                        "$$ LANGUAGE SQL IMMUTABLE;")
+
+
+def _create_trigram_extension() -> bool:
+    conn = None
+    try:
+        conn = _new_connection()
+        conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        return True
+    except Exception as e:
+        return False
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+@_profiled
+@_sharded(_route_to_all_shards)
 def create_tables() -> None:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        trigram = _create_trigram_extension()
+        if not trigram:
+            _log.warning("pg_trgm is not available, the search scans the tables for substring matches")
+        conn = _new_connection()
         conn.execute("CREATE TABLE CUSTOMERS("
                      "cust_id INTEGER NOT NULL PRIMARY KEY CHECK (cust_id > 0),"
                      "full_name TEXT NOT NULL,"
                      "phone TEXT NOT NULL,"
                      "address TEXT NOT NULL CHECK (LENGTH(address) >= 3));"
                      ""
+                     "CREATE SEQUENCE ORDERS_CHANGE_SEQ;"
+                     ""
+                     "CREATE FUNCTION NEXT_ORDER_CHANGE() RETURNS BIGINT AS $$ "
+                     "BEGIN "
+                     "PERFORM pg_advisory_xact_lock_shared(hashtext('ORDERS_CHANGE_SEQ')); "
+                     "RETURN nextval('ORDERS_CHANGE_SEQ'); "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
                      "CREATE TABLE ORDERS("
                      "order_id INTEGER NOT NULL PRIMARY KEY CHECK (order_id > 0),"
-                     "date TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL);"
+                     "date TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,"
+                     "change_seq BIGINT NOT NULL DEFAULT NEXT_ORDER_CHANGE());"
+                     ""
+                     "CREATE TABLE ORDERS_DELETED("
+                     "order_id INTEGER NOT NULL PRIMARY KEY,"
+                     "change_seq BIGINT NOT NULL);"
                      ""
                      "CREATE TABLE DISHES("
                      "dish_id INTEGER NOT NULL PRIMARY KEY CHECK (dish_id > 0),"
@@ -38,7 +997,8 @@ def create_tables() -> None:
                      "order_id INTEGER PRIMARY KEY NOT NULL CHECK (order_id > 0),"
                      "FOREIGN KEY(order_id) REFERENCES ORDERS(order_id) ON DELETE CASCADE,"
                      "cust_id INTEGER NOT NULL CHECK (cust_id > 0),"
-                     "FOREIGN KEY(cust_id) REFERENCES CUSTOMERS(cust_id) ON DELETE CASCADE);"
+                     "FOREIGN KEY(cust_id) REFERENCES CUSTOMERS(cust_id) ON DELETE CASCADE,"
+                     "order_price DECIMAL NOT NULL DEFAULT 0.0);"
                      ""
                      "CREATE TABLE DISHES_IN_ORDERS("
                      "order_id INTEGER NOT NULL CHECK (order_id > 0),"
@@ -56,6 +1016,27 @@ def create_tables() -> None:
                      "FOREIGN KEY (dish_id) REFERENCES DISHES(dish_id) ON DELETE CASCADE,"
                      "PRIMARY KEY (cust_id, dish_id));"
                      ""
+                     "CREATE TABLE CUSTOMERS_SPEND_SUMMARY("
+                     "cust_id INTEGER NOT NULL PRIMARY KEY,"
+                     "FOREIGN KEY(cust_id) REFERENCES CUSTOMERS(cust_id) ON DELETE CASCADE,"
+                     "order_count INTEGER NOT NULL,"
+                     "total_spent DECIMAL NOT NULL,"
+                     "max_order_price DECIMAL NOT NULL);"
+                     ""
+                     "CREATE TABLE SALES_PER_HOUR("
+                     "sales_hour TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,"
+                     "dish_id INTEGER NOT NULL,"
+                     "amount BIGINT NOT NULL,"
+                     "profit DECIMAL NOT NULL,"
+                     "PRIMARY KEY(sales_hour, dish_id));"
+                     ""
+                     "CREATE INDEX SALES_PER_HOUR_DISH_IDX ON SALES_PER_HOUR(dish_id, sales_hour);"
+                     "CREATE INDEX CUSTOMERS_LIKE_DISHES_DISH_IDX ON CUSTOMERS_LIKE_DISHES(dish_id, cust_id);"
+                     "CREATE INDEX ORDERS_DATE_IDX ON ORDERS(date);"
+                     "CREATE INDEX ORDERS_CHANGE_SEQ_IDX ON ORDERS(change_seq);"
+                     "CREATE INDEX ORDERS_DELETED_CHANGE_SEQ_IDX ON ORDERS_DELETED(change_seq);"
+                     "CREATE INDEX CUSTOMERS_PLACE_ORDERS_CUST_IDX ON CUSTOMERS_PLACE_ORDERS(cust_id, order_price);"
+                     ""
                      "CREATE VIEW ACTIVE_DISHES_VIEW AS "
                      "SELECT dish_id, price "
                      "FROM DISHES "
@@ -123,7 +1104,260 @@ def create_tables() -> None:
                      "SELECT D.dish_id, ODPW.average_profit AS current_average_profit "
                      "FROM DISHES D JOIN ORDERED_DISHES_PROFIT_VIEW ODPW "
                      "ON D.dish_id = ODPW.dish_id "
-                     "WHERE D.is_active = TRUE AND D.price = ODPW.price;")
+                     "WHERE D.is_active = TRUE AND D.price = ODPW.price;"
+                     ""
+                     "CREATE FUNCTION NOTIFY_TABLE_CHANGE() RETURNS TRIGGER AS $$ "
+                     "DECLARE changed_rows BIGINT; changed_keys BIGINT; changed_key TEXT; "
+                     "BEGIN "
+                     "IF current_setting('solution.defer_notify', true) = 'on' THEN "
+                     "RETURN NULL; "
+                     "END IF; "
+                     "IF TG_OP = 'INSERT' THEN "
+                     "SELECT COUNT(*), COUNT(DISTINCT R ->> TG_ARGV[0]), MIN(R ->> TG_ARGV[0]) "
+                     "INTO changed_rows, changed_keys, changed_key "
+                     "FROM (SELECT to_jsonb(N) AS R FROM NEW_ROWS N) AS CHANGED; "
+                     "ELSIF TG_OP = 'DELETE' THEN "
+                     "SELECT COUNT(*), COUNT(DISTINCT R ->> TG_ARGV[0]), MIN(R ->> TG_ARGV[0]) "
+                     "INTO changed_rows, changed_keys, changed_key "
+                     "FROM (SELECT to_jsonb(O) AS R FROM OLD_ROWS O) AS CHANGED; "
+                     "ELSE "
+                     "SELECT COUNT(*), COUNT(DISTINCT R ->> TG_ARGV[0]), MIN(R ->> TG_ARGV[0]) "
+                     "INTO changed_rows, changed_keys, changed_key "
+                     "FROM ((SELECT to_jsonb(N) - TG_ARGV[1:TG_NARGS] AS R FROM NEW_ROWS N "
+                     "EXCEPT SELECT to_jsonb(O) - TG_ARGV[1:TG_NARGS] FROM OLD_ROWS O) "
+                     "UNION ALL (SELECT to_jsonb(O) - TG_ARGV[1:TG_NARGS] FROM OLD_ROWS O "
+                     "EXCEPT SELECT to_jsonb(N) - TG_ARGV[1:TG_NARGS] FROM NEW_ROWS N)) AS CHANGED; "
+                     "END IF; "
+                     "IF changed_rows = 0 THEN "
+                     "RETURN NULL; "
+                     "END IF; "
+                     "PERFORM pg_notify('table_changes', UPPER(TG_TABLE_NAME) || "
+                     "(CASE WHEN changed_keys = 1 THEN ':' || changed_key ELSE '' END)); "
+                     "RETURN NULL; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE TRIGGER CUSTOMERS_INSERT_NOTIFY AFTER INSERT ON CUSTOMERS "
+                     "REFERENCING NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('cust_id');"
+                     "CREATE TRIGGER CUSTOMERS_UPDATE_NOTIFY AFTER UPDATE ON CUSTOMERS "
+                     "REFERENCING OLD TABLE AS OLD_ROWS NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('cust_id');"
+                     "CREATE TRIGGER CUSTOMERS_DELETE_NOTIFY AFTER DELETE ON CUSTOMERS "
+                     "REFERENCING OLD TABLE AS OLD_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('cust_id');"
+                     ""
+                     "CREATE TRIGGER ORDERS_INSERT_NOTIFY AFTER INSERT ON ORDERS "
+                     "REFERENCING NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('order_id', 'change_seq');"
+                     "CREATE TRIGGER ORDERS_UPDATE_NOTIFY AFTER UPDATE ON ORDERS "
+                     "REFERENCING OLD TABLE AS OLD_ROWS NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('order_id', 'change_seq');"
+                     "CREATE TRIGGER ORDERS_DELETE_NOTIFY AFTER DELETE ON ORDERS "
+                     "REFERENCING OLD TABLE AS OLD_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('order_id', 'change_seq');"
+                     ""
+                     "CREATE TRIGGER DISHES_INSERT_NOTIFY AFTER INSERT ON DISHES "
+                     "REFERENCING NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('dish_id');"
+                     "CREATE TRIGGER DISHES_UPDATE_NOTIFY AFTER UPDATE ON DISHES "
+                     "REFERENCING OLD TABLE AS OLD_ROWS NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('dish_id');"
+                     "CREATE TRIGGER DISHES_DELETE_NOTIFY AFTER DELETE ON DISHES "
+                     "REFERENCING OLD TABLE AS OLD_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('dish_id');"
+                     ""
+                     "CREATE TRIGGER CUSTOMERS_PLACE_ORDERS_INSERT_NOTIFY AFTER INSERT ON CUSTOMERS_PLACE_ORDERS "
+                     "REFERENCING NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('', 'order_price');"
+                     "CREATE TRIGGER CUSTOMERS_PLACE_ORDERS_UPDATE_NOTIFY AFTER UPDATE ON CUSTOMERS_PLACE_ORDERS "
+                     "REFERENCING OLD TABLE AS OLD_ROWS NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('', 'order_price');"
+                     "CREATE TRIGGER CUSTOMERS_PLACE_ORDERS_DELETE_NOTIFY AFTER DELETE ON CUSTOMERS_PLACE_ORDERS "
+                     "REFERENCING OLD TABLE AS OLD_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('', 'order_price');"
+                     ""
+                     "CREATE TRIGGER DISHES_IN_ORDERS_INSERT_NOTIFY AFTER INSERT ON DISHES_IN_ORDERS "
+                     "REFERENCING NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('');"
+                     "CREATE TRIGGER DISHES_IN_ORDERS_UPDATE_NOTIFY AFTER UPDATE ON DISHES_IN_ORDERS "
+                     "REFERENCING OLD TABLE AS OLD_ROWS NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('');"
+                     "CREATE TRIGGER DISHES_IN_ORDERS_DELETE_NOTIFY AFTER DELETE ON DISHES_IN_ORDERS "
+                     "REFERENCING OLD TABLE AS OLD_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('');"
+                     ""
+                     "CREATE TRIGGER CUSTOMERS_LIKE_DISHES_INSERT_NOTIFY AFTER INSERT ON CUSTOMERS_LIKE_DISHES "
+                     "REFERENCING NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('');"
+                     "CREATE TRIGGER CUSTOMERS_LIKE_DISHES_UPDATE_NOTIFY AFTER UPDATE ON CUSTOMERS_LIKE_DISHES "
+                     "REFERENCING OLD TABLE AS OLD_ROWS NEW TABLE AS NEW_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('');"
+                     "CREATE TRIGGER CUSTOMERS_LIKE_DISHES_DELETE_NOTIFY AFTER DELETE ON CUSTOMERS_LIKE_DISHES "
+                     "REFERENCING OLD TABLE AS OLD_ROWS FOR EACH STATEMENT "
+                     "EXECUTE PROCEDURE NOTIFY_TABLE_CHANGE('');"
+                     ""
+                     "CREATE FUNCTION ORDER_CONTENT_CHANGE() RETURNS TRIGGER AS $$ "
+                     "BEGIN "
+                     "UPDATE ORDERS SET change_seq = NEXT_ORDER_CHANGE() "
+                     "WHERE order_id = (CASE WHEN TG_OP = 'DELETE' THEN OLD.order_id ELSE NEW.order_id END); "
+                     "RETURN NULL; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE FUNCTION CUSTOMERS_ORDERS_CHANGE() RETURNS TRIGGER AS $$ "
+                     "BEGIN "
+                     "UPDATE ORDERS SET change_seq = NEXT_ORDER_CHANGE() "
+                     "WHERE order_id IN (SELECT order_id FROM CUSTOMERS_PLACE_ORDERS WHERE cust_id = OLD.cust_id); "
+                     "RETURN OLD; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE TRIGGER DISHES_IN_ORDERS_CHANGE_STAMP AFTER INSERT OR UPDATE OR DELETE "
+                     "ON DISHES_IN_ORDERS FOR EACH ROW EXECUTE PROCEDURE ORDER_CONTENT_CHANGE();"
+                     ""
+                     "CREATE TRIGGER CUSTOMERS_PLACE_ORDERS_CHANGE_STAMP AFTER INSERT OR UPDATE OR DELETE "
+                     "ON CUSTOMERS_PLACE_ORDERS FOR EACH ROW EXECUTE PROCEDURE ORDER_CONTENT_CHANGE();"
+                     ""
+                     "CREATE TRIGGER CUSTOMERS_ORDERS_CHANGE_STAMP BEFORE DELETE "
+                     "ON CUSTOMERS FOR EACH ROW EXECUTE PROCEDURE CUSTOMERS_ORDERS_CHANGE();"
+                     ""
+                     "CREATE FUNCTION ORDERS_DELETION_LOG() RETURNS TRIGGER AS $$ "
+                     "BEGIN "
+                     "IF TG_OP = 'INSERT' THEN "
+                     "DELETE FROM ORDERS_DELETED WHERE order_id = NEW.order_id; "
+                     "ELSIF current_setting('solution.order_moved', true) IS DISTINCT FROM 'on' THEN "
+                     "INSERT INTO ORDERS_DELETED(order_id, change_seq) VALUES (OLD.order_id, NEXT_ORDER_CHANGE()) "
+                     "ON CONFLICT (order_id) DO UPDATE SET change_seq = EXCLUDED.change_seq; "
+                     "END IF; "
+                     "RETURN NULL; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE TRIGGER ORDERS_DELETION_LOG_REFRESH AFTER INSERT OR DELETE "
+                     "ON ORDERS FOR EACH ROW EXECUTE PROCEDURE ORDERS_DELETION_LOG();"
+                     ""
+                     "CREATE FUNCTION APPLY_CUSTOMER_SPEND(customer INTEGER, orders_delta INTEGER, "
+                     "spent_delta DECIMAL, placed_price DECIMAL) RETURNS VOID AS $$ "
+                     "BEGIN "
+                     "PERFORM 1 FROM CUSTOMERS WHERE cust_id = customer FOR KEY SHARE; "
+                     "PERFORM pg_advisory_xact_lock(hashtext('CUSTOMERS_SPEND_SUMMARY'), customer); "
+                     "IF orders_delta > 0 THEN "
+                     "INSERT INTO CUSTOMERS_SPEND_SUMMARY(cust_id, order_count, total_spent, max_order_price) "
+                     "VALUES (customer, orders_delta, spent_delta, placed_price) "
+                     "ON CONFLICT (cust_id) DO UPDATE "
+                     "SET order_count = CUSTOMERS_SPEND_SUMMARY.order_count + EXCLUDED.order_count, "
+                     "total_spent = CUSTOMERS_SPEND_SUMMARY.total_spent + EXCLUDED.total_spent, "
+                     "max_order_price = GREATEST(CUSTOMERS_SPEND_SUMMARY.max_order_price, EXCLUDED.max_order_price); "
+                     "ELSIF orders_delta = 0 AND spent_delta >= 0 THEN "
+                     "UPDATE CUSTOMERS_SPEND_SUMMARY SET total_spent = total_spent + spent_delta, "
+                     "max_order_price = GREATEST(max_order_price, placed_price) "
+                     "WHERE cust_id = customer; "
+                     "ELSE "
+                     "UPDATE CUSTOMERS_SPEND_SUMMARY SET order_count = order_count + orders_delta, "
+                     "total_spent = total_spent + spent_delta, "
+                     "max_order_price = (SELECT COALESCE(MAX(CPO.order_price), 0.0) FROM CUSTOMERS_PLACE_ORDERS CPO "
+                     "WHERE CPO.cust_id = customer) "
+                     "WHERE cust_id = customer; "
+                     "END IF; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE FUNCTION APPLY_ORDER_SPEND(changed_order INTEGER, spent_delta DECIMAL) RETURNS VOID AS $$ "
+                     "DECLARE customer INTEGER; placed_price DECIMAL; "
+                     "BEGIN "
+                     "PERFORM 1 FROM ORDERS WHERE order_id = changed_order FOR NO KEY UPDATE; "
+                     "UPDATE CUSTOMERS_PLACE_ORDERS SET order_price = order_price + spent_delta "
+                     "WHERE order_id = changed_order RETURNING cust_id, order_price INTO customer, placed_price; "
+                     "IF FOUND THEN "
+                     "PERFORM APPLY_CUSTOMER_SPEND(customer, 0, spent_delta, placed_price); "
+                     "END IF; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE FUNCTION DISHES_IN_ORDERS_SPEND_CHANGE() RETURNS TRIGGER AS $$ "
+                     "BEGIN "
+                     "IF TG_OP != 'INSERT' THEN "
+                     "PERFORM APPLY_ORDER_SPEND(OLD.order_id, -OLD.amount * OLD.price); "
+                     "END IF; "
+                     "IF TG_OP != 'DELETE' THEN "
+                     "PERFORM APPLY_ORDER_SPEND(NEW.order_id, NEW.amount * NEW.price); "
+                     "END IF; "
+                     "RETURN NULL; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE FUNCTION CUSTOMERS_PLACE_ORDERS_PRICE() RETURNS TRIGGER AS $$ "
+                     "BEGIN "
+                     "PERFORM 1 FROM ORDERS WHERE order_id = NEW.order_id FOR NO KEY UPDATE; "
+                     "SELECT COALESCE(SUM(amount * price), 0.0) INTO NEW.order_price "
+                     "FROM DISHES_IN_ORDERS WHERE order_id = NEW.order_id; "
+                     "RETURN NEW; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE FUNCTION CUSTOMERS_PLACE_ORDERS_SPEND_CHANGE() RETURNS TRIGGER AS $$ "
+                     "BEGIN "
+                     "IF TG_OP != 'INSERT' THEN "
+                     "PERFORM APPLY_CUSTOMER_SPEND(OLD.cust_id, -1, -OLD.order_price, 0.0); "
+                     "END IF; "
+                     "IF TG_OP != 'DELETE' THEN "
+                     "PERFORM APPLY_CUSTOMER_SPEND(NEW.cust_id, 1, NEW.order_price, NEW.order_price); "
+                     "END IF; "
+                     "RETURN NULL; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE TRIGGER DISHES_IN_ORDERS_SPEND_REFRESH AFTER INSERT OR UPDATE OR DELETE "
+                     "ON DISHES_IN_ORDERS FOR EACH ROW EXECUTE PROCEDURE DISHES_IN_ORDERS_SPEND_CHANGE();"
+                     ""
+                     "CREATE TRIGGER CUSTOMERS_PLACE_ORDERS_PRICE_SET BEFORE INSERT "
+                     "ON CUSTOMERS_PLACE_ORDERS FOR EACH ROW EXECUTE PROCEDURE CUSTOMERS_PLACE_ORDERS_PRICE();"
+                     ""
+                     "CREATE TRIGGER CUSTOMERS_PLACE_ORDERS_SPEND_REFRESH AFTER INSERT OR DELETE OR UPDATE OF cust_id "
+                     "ON CUSTOMERS_PLACE_ORDERS FOR EACH ROW EXECUTE PROCEDURE CUSTOMERS_PLACE_ORDERS_SPEND_CHANGE();"
+                     ""
+                     "CREATE FUNCTION DISHES_IN_ORDERS_SALES_CHANGE() RETURNS TRIGGER AS $$ "
+                     "DECLARE order_hour TIMESTAMP(0); "
+                     "BEGIN "
+                     "IF TG_OP != 'INSERT' THEN "
+                     "SELECT date_trunc('hour', date) INTO order_hour FROM ORDERS WHERE order_id = OLD.order_id; "
+                     "IF FOUND THEN "
+                     "UPDATE SALES_PER_HOUR SET amount = amount - OLD.amount, profit = profit - OLD.amount * OLD.price "
+                     "WHERE sales_hour = order_hour AND dish_id = OLD.dish_id; "
+                     "DELETE FROM SALES_PER_HOUR "
+                     "WHERE sales_hour = order_hour AND dish_id = OLD.dish_id AND amount = 0; "
+                     "END IF; "
+                     "END IF; "
+                     "IF TG_OP != 'DELETE' THEN "
+                     "SELECT date_trunc('hour', date) INTO order_hour FROM ORDERS WHERE order_id = NEW.order_id; "
+                     "INSERT INTO SALES_PER_HOUR(sales_hour, dish_id, amount, profit) "
+                     "VALUES (order_hour, NEW.dish_id, NEW.amount, NEW.amount * NEW.price) "
+                     "ON CONFLICT (sales_hour, dish_id) DO UPDATE "
+                     "SET amount = SALES_PER_HOUR.amount + EXCLUDED.amount, "
+                     "profit = SALES_PER_HOUR.profit + EXCLUDED.profit; "
+                     "END IF; "
+                     "RETURN NULL; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE FUNCTION ORDERS_SALES_CHANGE() RETURNS TRIGGER AS $$ "
+                     "BEGIN "
+                     "UPDATE SALES_PER_HOUR S SET amount = S.amount - DIO.amount, "
+                     "profit = S.profit - DIO.amount * DIO.price "
+                     "FROM DISHES_IN_ORDERS DIO "
+                     "WHERE DIO.order_id = OLD.order_id AND S.dish_id = DIO.dish_id "
+                     "AND S.sales_hour = date_trunc('hour', OLD.date); "
+                     "DELETE FROM SALES_PER_HOUR WHERE sales_hour = date_trunc('hour', OLD.date) AND amount = 0; "
+                     "IF TG_OP = 'UPDATE' THEN "
+                     "INSERT INTO SALES_PER_HOUR(sales_hour, dish_id, amount, profit) "
+                     "SELECT date_trunc('hour', NEW.date), DIO.dish_id, DIO.amount, DIO.amount * DIO.price "
+                     "FROM DISHES_IN_ORDERS DIO WHERE DIO.order_id = OLD.order_id "
+                     "ON CONFLICT (sales_hour, dish_id) DO UPDATE "
+                     "SET amount = SALES_PER_HOUR.amount + EXCLUDED.amount, "
+                     "profit = SALES_PER_HOUR.profit + EXCLUDED.profit; "
+                     "RETURN NEW; "
+                     "END IF; "
+                     "RETURN OLD; "
+                     "END; $$ LANGUAGE plpgsql;"
+                     ""
+                     "CREATE TRIGGER DISHES_IN_ORDERS_SALES_REFRESH AFTER INSERT OR UPDATE OR DELETE "
+                     "ON DISHES_IN_ORDERS FOR EACH ROW EXECUTE PROCEDURE DISHES_IN_ORDERS_SALES_CHANGE();"
+                     ""
+                     "CREATE TRIGGER ORDERS_SALES_REFRESH BEFORE DELETE OR UPDATE OF date "
+                     "ON ORDERS FOR EACH ROW EXECUTE PROCEDURE ORDERS_SALES_CHANGE();")
+        conn.execute(_PREFIX_SEARCH_SCHEMA + (_TRIGRAM_SEARCH_SCHEMA if trigram else _PLAIN_SEARCH_SCHEMA))
+        _bump_table_versions(*_ALL_TABLES)
     except DatabaseException.ConnectionInvalid as e:
         return None
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -142,16 +1376,19 @@ def create_tables() -> None:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_to_all_shards)
 def clear_tables() -> None:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         conn.execute("DELETE FROM CUSTOMERS_LIKE_DISHES;"
                      "DELETE FROM DISHES_IN_ORDERS;"
                      "DELETE FROM CUSTOMERS_PLACE_ORDERS;"
                      "DELETE FROM ORDERS;"
                      "DELETE FROM DISHES;"
                      "DELETE FROM CUSTOMERS;")
+        _bump_table_versions(*_ALL_TABLES)
     except DatabaseException.ConnectionInvalid as e:
         return None
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -169,10 +1406,12 @@ def clear_tables() -> None:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_to_all_shards)
 def drop_tables() -> None:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         conn.execute("DROP VIEW IF EXISTS ACTIVE_ORDERED_DISHES_CURRENT_PROFIT_VIEW;"
                      "DROP VIEW IF EXISTS ORDERED_DISHES_PROFIT_VIEW;"
                      "DROP VIEW IF EXISTS SIMILAR_CUSTOMERS_VIEW;"
@@ -183,12 +1422,30 @@ def drop_tables() -> None:
                      "DROP VIEW IF EXISTS MOST_LIKED_DISHES_RANKING_VIEW;"
                      "DROP VIEW IF EXISTS CUSTOMERS_ORDERS_TOTAL_PRICE_VIEW;"
                      "DROP VIEW IF EXISTS ACTIVE_DISHES_VIEW;"
+                     "DROP TABLE IF EXISTS SALES_PER_HOUR CASCADE;"
+                     "DROP TABLE IF EXISTS CUSTOMERS_SPEND_SUMMARY CASCADE;"
                      "DROP TABLE IF EXISTS CUSTOMERS_LIKE_DISHES CASCADE;"
                      "DROP TABLE IF EXISTS DISHES_IN_ORDERS CASCADE;"
                      "DROP TABLE IF EXISTS CUSTOMERS_PLACE_ORDERS CASCADE;"
                      "DROP TABLE IF EXISTS ORDERS CASCADE;"
+                     "DROP TABLE IF EXISTS ORDERS_DELETED CASCADE;"
                      "DROP TABLE IF EXISTS DISHES CASCADE;"
-                     "DROP TABLE IF EXISTS CUSTOMERS CASCADE;")
+                     "DROP TABLE IF EXISTS CUSTOMERS CASCADE;"
+                     "DROP FUNCTION IF EXISTS NOTIFY_TABLE_CHANGE() CASCADE;"
+                     "DROP FUNCTION IF EXISTS ORDER_CONTENT_CHANGE() CASCADE;"
+                     "DROP FUNCTION IF EXISTS CUSTOMERS_ORDERS_CHANGE() CASCADE;"
+                     "DROP FUNCTION IF EXISTS ORDERS_DELETION_LOG() CASCADE;"
+                     "DROP FUNCTION IF EXISTS NEXT_ORDER_CHANGE() CASCADE;"
+                     "DROP SEQUENCE IF EXISTS ORDERS_CHANGE_SEQ;"
+                     "DROP FUNCTION IF EXISTS DISHES_IN_ORDERS_SPEND_CHANGE() CASCADE;"
+                     "DROP FUNCTION IF EXISTS CUSTOMERS_PLACE_ORDERS_SPEND_CHANGE() CASCADE;"
+                     "DROP FUNCTION IF EXISTS CUSTOMERS_PLACE_ORDERS_PRICE() CASCADE;"
+                     "DROP FUNCTION IF EXISTS APPLY_ORDER_SPEND(INTEGER, DECIMAL) CASCADE;"
+                     "DROP FUNCTION IF EXISTS APPLY_CUSTOMER_SPEND(INTEGER, INTEGER, DECIMAL, DECIMAL) CASCADE;"
+                     "DROP FUNCTION IF EXISTS DISHES_IN_ORDERS_SALES_CHANGE() CASCADE;"
+                     "DROP FUNCTION IF EXISTS ORDERS_SALES_CHANGE() CASCADE;"
+                     "DROP FUNCTION IF EXISTS SEARCH_SIMILARITY(TEXT, TEXT) CASCADE;")
+        _bump_table_versions(*_ALL_TABLES)
     except DatabaseException.ConnectionInvalid as e:
         return None
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -209,10 +1466,12 @@ def drop_tables() -> None:
 
 # CRUD API
 
+@_profiled
+@_sharded(_route_by_customer_object)
 def add_customer(customer: Customer) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("INSERT INTO CUSTOMERS(cust_id, full_name, phone, address)"
                         "VALUES({}, {}, {}, {})").format(sql.Literal(customer.get_cust_id()),
                                                          sql.Literal(customer.get_full_name()),
@@ -220,6 +1479,7 @@ def add_customer(customer: Customer) -> ReturnValue:
                                                          sql.Literal(customer.get_address()))
 
         rows_effected, _ = conn.execute(query)
+        _bump_table_versions('CUSTOMERS')
     except DatabaseException.ConnectionInvalid as e:
         return ReturnValue.ERROR
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -238,10 +1498,12 @@ def add_customer(customer: Customer) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_by_customer)
 def get_customer(customer_id: int) -> Customer:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT cust_id, full_name, phone, address FROM CUSTOMERS WHERE cust_id = {id}").format(
             id=sql.Literal(customer_id))
         rows_effected, res = conn.execute(query)
@@ -256,14 +1518,17 @@ def get_customer(customer_id: int) -> Customer:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_by_customer)
 def delete_customer(customer_id: int) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("DELETE FROM CUSTOMERS WHERE cust_id = {id}").format(id=sql.Literal(customer_id))
         rows_effected, _ = conn.execute(query)
         if not rows_effected:
             return ReturnValue.NOT_EXISTS
+        _bump_table_versions('CUSTOMERS', 'CUSTOMERS_PLACE_ORDERS', 'CUSTOMERS_LIKE_DISHES')
     except DatabaseException.ConnectionInvalid as e:
         return ReturnValue.ERROR
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -282,13 +1547,16 @@ def delete_customer(customer_id: int) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_add_order)
 def add_order(order: Order) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("INSERT INTO ORDERS(order_id, date)"
                         "VALUES({}, {})").format(sql.Literal(order.get_order_id()), sql.Literal(order.get_datetime()))
         rows_effected, _ = conn.execute(query)
+        _bump_table_versions('ORDERS')
         # if not rows_effected:
         #     return ReturnValue.ALREADY_EXISTS
     except DatabaseException.ConnectionInvalid as e:
@@ -309,10 +1577,12 @@ def add_order(order: Order) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_by_order)
 def get_order(order_id: int) -> Order:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT order_id, date FROM ORDERS WHERE order_id = {id}").format(
             id=sql.Literal(order_id))
         rows_effected, res = conn.execute(query)
@@ -327,14 +1597,17 @@ def get_order(order_id: int) -> Order:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_by_order)
 def delete_order(order_id: int) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("DELETE FROM ORDERS WHERE order_id = {id}").format(id=sql.Literal(order_id))
         rows_effected, _ = conn.execute(query)
         if not rows_effected:
             return ReturnValue.NOT_EXISTS
+        _bump_table_versions('ORDERS', 'CUSTOMERS_PLACE_ORDERS', 'DISHES_IN_ORDERS')
     except DatabaseException.ConnectionInvalid as e:
         return ReturnValue.ERROR
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -353,10 +1626,12 @@ def delete_order(order_id: int) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_replicated_write)
 def add_dish(dish: Dish) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL(
             "INSERT INTO DISHES(dish_id, name, price, is_active) VALUES({}, {}, {}, {})").format(
             sql.Literal(dish.get_dish_id()),
@@ -367,6 +1642,7 @@ def add_dish(dish: Dish) -> ReturnValue:
         rows_effected, _ = conn.execute(query)
         if rows_effected == 0:
             return ReturnValue.ALREADY_EXISTS
+        _bump_table_versions('DISHES')
     except DatabaseException.ConnectionInvalid as e:
         return ReturnValue.ERROR
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -385,10 +1661,12 @@ def add_dish(dish: Dish) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_by_dish)
 def get_dish(dish_id: int) -> Dish:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT dish_id, name, price, is_active FROM DISHES WHERE dish_id = {id}").format(
             id=sql.Literal(dish_id)
         )
@@ -405,10 +1683,12 @@ def get_dish(dish_id: int) -> Dish:
 
 
 # CHECKED
+@_profiled
+@_sharded(_route_replicated_write)
 def update_dish_price(dish_id: int, price: float) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("UPDATE DISHES SET price = {price} WHERE dish_id = {id} "
                         "AND price > 0 AND {id} IN (SELECT dish_id FROM ACTIVE_DISHES_VIEW)").format(
             price=sql.Literal(price),
@@ -417,6 +1697,7 @@ def update_dish_price(dish_id: int, price: float) -> ReturnValue:
         rows_effected, _ = conn.execute(query)
         if rows_effected == 0:
             return ReturnValue.NOT_EXISTS
+        _bump_table_versions('DISHES')
     except DatabaseException.ConnectionInvalid as e:
         return ReturnValue.ERROR
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -435,10 +1716,12 @@ def update_dish_price(dish_id: int, price: float) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_replicated_write)
 def update_dish_active_status(dish_id: int, is_active: bool) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("UPDATE DISHES SET is_active = {is_active} WHERE dish_id = {id}").format(
             is_active=sql.Literal(is_active),
             id=sql.Literal(dish_id)
@@ -446,6 +1729,7 @@ def update_dish_active_status(dish_id: int, is_active: bool) -> ReturnValue:
         rows_effected, _ = conn.execute(query)
         if rows_effected == 0:
             return ReturnValue.NOT_EXISTS
+        _bump_table_versions('DISHES')
     except DatabaseException.ConnectionInvalid as e:
         return ReturnValue.ERROR
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -464,13 +1748,16 @@ def update_dish_active_status(dish_id: int, is_active: bool) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_customer_placed_order)
 def customer_placed_order(customer_id: int, order_id: int) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("INSERT INTO CUSTOMERS_PLACE_ORDERS(order_id, cust_id) VALUES({}, {})").format(
             sql.Literal(order_id), sql.Literal(customer_id))
         rows_effected, _ = conn.execute(query)
+        _bump_table_versions('CUSTOMERS_PLACE_ORDERS')
         # if rows_effected == 0:
         #     return ReturnValue.ALREADY_EXISTS
     except DatabaseException.ConnectionInvalid as e:
@@ -491,10 +1778,12 @@ def customer_placed_order(customer_id: int, order_id: int) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_by_order)
 def get_customer_that_placed_order(order_id: int) -> Customer:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL(
             "SELECT cust_id, full_name, phone, address FROM CUSTOMERS "
             "WHERE cust_id = ("
@@ -513,10 +1802,12 @@ def get_customer_that_placed_order(order_id: int) -> Customer:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_by_order)
 def order_contains_dish(order_id: int, dish_id: int, amount: int) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("INSERT INTO DISHES_IN_ORDERS(order_id, dish_id, amount, price) "
                         "SELECT {id_order}, {id_dish}, {dish_amount}, ADV.price "
                         "FROM ACTIVE_DISHES_VIEW ADV "
@@ -526,6 +1817,7 @@ def order_contains_dish(order_id: int, dish_id: int, amount: int) -> ReturnValue
         rows_effected, _ = conn.execute(query)
         if rows_effected == 0:
             return ReturnValue.NOT_EXISTS  # wasn't in active_dishes_view (might not be there since id is invalid)
+        _bump_table_versions('DISHES_IN_ORDERS')
     except DatabaseException.ConnectionInvalid as e:
         return ReturnValue.ERROR
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -544,10 +1836,12 @@ def order_contains_dish(order_id: int, dish_id: int, amount: int) -> ReturnValue
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_by_order)
 def order_does_not_contain_dish(order_id: int, dish_id: int) -> ReturnValue:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("DELETE FROM DISHES_IN_ORDERS WHERE order_id = {order_id} AND dish_id = {dish_id}").format(
             order_id=sql.Literal(order_id),
             dish_id=sql.Literal(dish_id),
@@ -555,6 +1849,7 @@ def order_does_not_contain_dish(order_id: int, dish_id: int) -> ReturnValue:
         rows_effected, _ = conn.execute(query)
         if rows_effected == 0:
             return ReturnValue.NOT_EXISTS
+        _bump_table_versions('DISHES_IN_ORDERS')
     except DatabaseException.ConnectionInvalid as e:
         return ReturnValue.ERROR
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -573,10 +1868,12 @@ def order_does_not_contain_dish(order_id: int, dish_id: int) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_by_order)
 def get_all_order_items(order_id: int) -> List[OrderDish]:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT dish_id, amount, price FROM DISHES_IN_ORDERS WHERE order_id = {id} ORDER BY "
                         "dish_id ASC").format(id=sql.Literal(order_id))
         rows_effected, res = conn.execute(query)
@@ -594,14 +1891,19 @@ def get_all_order_items(order_id: int) -> List[OrderDish]:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_by_customer)
 def customer_likes_dish(cust_id: int, dish_id: int) -> ReturnValue:
+    if _likes_buffering:
+        return _buffer_like_event(cust_id, dish_id, True)
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL(
             "INSERT INTO CUSTOMERS_LIKE_DISHES(cust_id, dish_id) VALUES({}, {})"
         ).format(sql.Literal(cust_id), sql.Literal(dish_id))
         rows_effected, _ = conn.execute(query)
+        _bump_table_versions('CUSTOMERS_LIKE_DISHES')
         # if rows_effected == 0:
         #     return ReturnValue.ALREADY_EXISTS
     except DatabaseException.ConnectionInvalid as e:
@@ -622,10 +1924,14 @@ def customer_likes_dish(cust_id: int, dish_id: int) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_by_customer)
 def customer_dislike_dish(cust_id: int, dish_id: int) -> ReturnValue:
+    if _likes_buffering:
+        return _buffer_like_event(cust_id, dish_id, False)
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL(
             "DELETE FROM CUSTOMERS_LIKE_DISHES WHERE cust_id = {} AND dish_id = {}"
         ).format(
@@ -634,6 +1940,7 @@ def customer_dislike_dish(cust_id: int, dish_id: int) -> ReturnValue:
         rows_effected, _ = conn.execute(query)
         if rows_effected == 0:
             return ReturnValue.NOT_EXISTS
+        _bump_table_versions('CUSTOMERS_LIKE_DISHES')
     except DatabaseException.ConnectionInvalid as e:
         return ReturnValue.ERROR
     except DatabaseException.NOT_NULL_VIOLATION as e:
@@ -652,10 +1959,12 @@ def customer_dislike_dish(cust_id: int, dish_id: int) -> ReturnValue:
     return ReturnValue.OK
 
 
+@_profiled
+@_sharded(_route_by_customer)
 def get_all_customer_likes(cust_id: int) -> List[Dish]:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT d.dish_id, d.name, d.price, d.is_active "
                         "FROM DISHES d JOIN CUSTOMERS_LIKE_DISHES cld ON d.dish_id = cld.dish_id "
                         "WHERE cld.cust_id = {cust_id} "
@@ -691,10 +2000,12 @@ def get_all_customer_likes(cust_id: int) -> List[Dish]:
 # Basic API
 
 #  in get_order_total_price the order id can be of an anonymous order
+@_profiled
+@_sharded(_route_by_order)
 def get_order_total_price(order_id: int) -> float:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT total_order_price FROM CUSTOMERS_ORDERS_TOTAL_PRICE_VIEW WHERE order_id = {id}").format(
             id=sql.Literal(order_id))
         rows_effected, res = conn.execute(query)
@@ -709,19 +2020,20 @@ def get_order_total_price(order_id: int) -> float:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_by_customer)
 def get_max_amount_of_money_cust_spent(cust_id: int) -> float:
     conn = None
     try:
-        conn = Connector.DBConnector()
-        query = sql.SQL("SELECT MAX(total_order_price) AS customer_max_money_order_spent "
-                        "FROM CUSTOMERS_ORDERS_TOTAL_PRICE_VIEW WHERE cust_id = {}").format(
+        conn = _new_connection()
+        query = sql.SQL("SELECT max_order_price FROM CUSTOMERS_SPEND_SUMMARY WHERE cust_id = {}").format(
             sql.Literal(cust_id)
         )
         rows_effected, res = conn.execute(query)
         if rows_effected == 0:
             return 0.0
         max_spent = res.rows[0][0]
-        return float(max_spent) if max_spent is not None else 0.0  # max() can return NULL if all the values are NULL
+        return float(max_spent)
     except Exception as e:
         pass
     finally:
@@ -729,10 +2041,12 @@ def get_max_amount_of_money_cust_spent(cust_id: int) -> float:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_most_expensive_anonymous_order)
 def get_most_expensive_anonymous_order() -> Order:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT O.order_id, O.date, COALESCE(SUM(DIO.price * DIO.amount), 0.0) AS total_price "
                         "FROM ORDERS O "
                         "LEFT OUTER JOIN DISHES_IN_ORDERS DIO ON O.order_id = DIO.order_id "
@@ -748,10 +2062,13 @@ def get_most_expensive_anonymous_order() -> Order:
             conn.close()
 
 
+@_profiled
+@_cached_query('DISHES', 'DISHES_IN_ORDERS', 'CUSTOMERS_LIKE_DISHES')
+@_sharded(_route_most_liked_dish_equal_to_most_purchased)
 def is_most_liked_dish_equal_to_most_purchased() -> bool:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT top_purchased.dish_id AS dish_id FROM"
                         "(SELECT MPDV.dish_id FROM MOST_PURCHASED_DISH_VIEW MPDV "
                         "ORDER BY MPDV.purchased_amount DESC, MPDV.dish_id ASC "
@@ -764,7 +2081,7 @@ def is_most_liked_dish_equal_to_most_purchased() -> bool:
         if rows_effected == 0:
             return False
     except Exception as e:
-        pass
+        _query_failed()
     finally:
         if conn is not None:
             conn.close()
@@ -775,10 +2092,13 @@ def is_most_liked_dish_equal_to_most_purchased() -> bool:
 
 # Advanced API
 
+@_profiled
+@_cached_query('DISHES', 'CUSTOMERS_PLACE_ORDERS', 'DISHES_IN_ORDERS', 'CUSTOMERS_LIKE_DISHES')
+@_sharded(_route_customers_ordered_top_5_dishes)
 def get_customers_ordered_top_5_dishes() -> List[int]:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT DISTINCT CPO.cust_id "
                         "FROM CUSTOMERS_PLACE_ORDERS CPO "
                         "INNER JOIN DISHES_IN_ORDERS DIO ON CPO.order_id = DIO.order_id "
@@ -792,26 +2112,28 @@ def get_customers_ordered_top_5_dishes() -> List[int]:
             return []
         return [row[0] for row in res.rows]
     except DatabaseException.ConnectionInvalid as e:
-        return []
+        return _query_failed([])
     except DatabaseException.NOT_NULL_VIOLATION as e:
-        return []
+        return _query_failed([])
     except DatabaseException.CHECK_VIOLATION as e:
-        return []
+        return _query_failed([])
     except DatabaseException.UNIQUE_VIOLATION as e:
-        return []
+        return _query_failed([])
     except DatabaseException.FOREIGN_KEY_VIOLATION as e:
-        return []
+        return _query_failed([])
     except Exception as e:
-        return []
+        return _query_failed([])
     finally:
         if conn is not None:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_non_worth_price_increase)
 def get_non_worth_price_increase() -> List[int]:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = ("SELECT DISTINCT ODPW.dish_id "
                  "FROM ORDERED_DISHES_PROFIT_VIEW ODPW "
                  "JOIN ACTIVE_ORDERED_DISHES_CURRENT_PROFIT_VIEW AODCPV "
@@ -841,10 +2163,13 @@ def get_non_worth_price_increase() -> List[int]:
             conn.close()
 
 
+@_profiled
+@_cached_query('ORDERS', 'DISHES_IN_ORDERS')
+@_sharded(_route_total_profit_per_month)
 def get_total_profit_per_month(year: int) -> List[Tuple[int, float]]:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT M.month, COALESCE(SUM(PPMV.profit), 0.0) AS profit "
                         "FROM MONTHS_VIEW M "
                         "LEFT OUTER JOIN PROFIT_PER_MONTH_VIEW PPMV "
@@ -857,26 +2182,28 @@ def get_total_profit_per_month(year: int) -> List[Tuple[int, float]]:
             profit_per_month.append((row[0], float(row[1])))
         return profit_per_month
     except DatabaseException.ConnectionInvalid as e:
-        return []
+        return _query_failed([])
     except DatabaseException.NOT_NULL_VIOLATION as e:
-        return []
+        return _query_failed([])
     except DatabaseException.CHECK_VIOLATION as e:
-        return []
+        return _query_failed([])
     except DatabaseException.UNIQUE_VIOLATION as e:
-        return []
+        return _query_failed([])
     except DatabaseException.FOREIGN_KEY_VIOLATION as e:
-        return []
+        return _query_failed([])
     except Exception as e:
-        return []
+        return _query_failed([])
     finally:
         if conn is not None:
             conn.close()
 
 
+@_profiled
+@_sharded(_route_potential_dish_recommendations)
 def get_potential_dish_recommendations(cust_id: int) -> List[int]:
     conn = None
     try:
-        conn = Connector.DBConnector()
+        conn = _new_connection()
         query = sql.SQL("SELECT DISTINCT CLD.dish_id "
                         "FROM CUSTOMERS_LIKE_DISHES CLD "
                         "WHERE CLD.cust_id IN(SELECT SCV.similar_customer "
@@ -905,3 +2232,812 @@ def get_potential_dish_recommendations(cust_id: int) -> List[int]:
     finally:
         if conn is not None:
             conn.close()
+
+
+# ---------------------------------- RECOMMENDATION API: ----------------------------------
+# customers are similar when they like at least min_shared of the same dishes. the similar customers are found
+# through the dish -> likers index of CUSTOMERS_LIKE_DISHES, starting from the dishes the customer likes, so a
+# request only reads the likes of the dishes and customers around it. a recommended dish scores one point per
+# similar customer that likes it, optionally weighted by how many times the dish was purchased.
+
+def _recommendation_score(likers: int, purchased: int, weight_by_purchases: bool) -> float:
+    return likers * (1 + math.log(1 + purchased)) if weight_by_purchases else float(likers)
+
+
+@_profiled
+@_sharded(_route_similar_customers)
+def get_similar_customers(cust_id: int, min_shared: int = 3, limit: int = None) -> List[Tuple[int, int]]:
+    # (similar cust_id, number of shared liked dishes), most similar first
+    conn = None
+    try:
+        conn = _new_connection()
+        query = sql.SQL("SELECT CLD.cust_id, COUNT(*) AS shared "
+                        "FROM CUSTOMERS_LIKE_DISHES MY "
+                        "JOIN CUSTOMERS_LIKE_DISHES CLD ON CLD.dish_id = MY.dish_id "
+                        "WHERE MY.cust_id = {id} AND CLD.cust_id != {id} "
+                        "GROUP BY CLD.cust_id "
+                        "HAVING COUNT(*) >= {min_shared} "
+                        "ORDER BY shared DESC, CLD.cust_id ASC "
+                        "LIMIT {limit}").format(id=sql.Literal(cust_id),
+                                                min_shared=sql.Literal(min_shared),
+                                                limit=sql.SQL("ALL") if limit is None else sql.Literal(limit))
+        rows_effected, res = conn.execute(query)
+        if rows_effected == 0:
+            return []
+        return [(row[0], row[1]) for row in res.rows]
+    except Exception as e:
+        return []
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+@_profiled
+@_sharded(_route_ranked_recommendations)
+def get_ranked_recommendations(cust_id: int, k: int = 10, min_shared: int = 3,
+                               weight_by_purchases: bool = False) -> List[int]:
+    conn = None
+    try:
+        conn = _new_connection()
+        if weight_by_purchases:
+            score = sql.SQL("COUNT(*) * (1 + LN(1 + COALESCE((SELECT SUM(SPH.amount) FROM SALES_PER_HOUR SPH "
+                            "WHERE SPH.dish_id = CLD.dish_id), 0)))")
+        else:
+            score = sql.SQL("COUNT(*)")
+        query = sql.SQL("SELECT CLD.dish_id, {score} AS score "
+                        "FROM CUSTOMERS_LIKE_DISHES CLD "
+                        "WHERE CLD.cust_id IN (SELECT OTHER.cust_id "
+                        "FROM CUSTOMERS_LIKE_DISHES MY "
+                        "JOIN CUSTOMERS_LIKE_DISHES OTHER ON OTHER.dish_id = MY.dish_id "
+                        "WHERE MY.cust_id = {id} AND OTHER.cust_id != {id} "
+                        "GROUP BY OTHER.cust_id "
+                        "HAVING COUNT(*) >= {min_shared}) "
+                        "AND CLD.dish_id NOT IN (SELECT dish_id FROM CUSTOMERS_LIKE_DISHES WHERE cust_id = {id}) "
+                        "GROUP BY CLD.dish_id "
+                        "ORDER BY score DESC, CLD.dish_id ASC "
+                        "LIMIT {k}").format(score=score, id=sql.Literal(cust_id),
+                                            min_shared=sql.Literal(min_shared), k=sql.Literal(k))
+        rows_effected, res = conn.execute(query)
+        if rows_effected == 0:
+            return []
+        return [row[0] for row in res.rows]
+    except Exception as e:
+        return []
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+# ---------------------------------- SPEND API: ----------------------------------
+# CUSTOMERS_SPEND_SUMMARY keeps the order count, total spent and most expensive order of every customer that
+# placed orders. the triggers created in create_tables keep the price of every placed order in
+# CUSTOMERS_PLACE_ORDERS.order_price and apply the change of each order line or placed order to the summary as a
+# delta; the maximum is only looked up again (through the (cust_id, order_price) index) when a price decreases.
+# the order row and a per-customer advisory lock serialize concurrent changes of the same order and customer.
+
+def _spend_stats(row: tuple) -> Tuple[int, int, float, float, float]:
+    cust_id, order_count, total_spent, max_order_price = row
+    return (cust_id, order_count, float(total_spent), float(max_order_price),
+            float(total_spent) / order_count if order_count else 0.0)
+
+
+@_sharded(_route_by_customer_list)
+def _customer_spend_rows(cust_ids: List[int]) -> List[tuple]:
+    return _fetch_rows(sql.SQL("SELECT C.cust_id, COALESCE(S.order_count, 0), COALESCE(S.total_spent, 0.0), "
+                               "COALESCE(S.max_order_price, 0.0) "
+                               "FROM CUSTOMERS C "
+                               "LEFT OUTER JOIN CUSTOMERS_SPEND_SUMMARY S ON C.cust_id = S.cust_id "
+                               "WHERE C.cust_id IN ({ids})").format(ids=_literal_list(cust_ids)))
+
+
+@_sharded(_gather_from_all_shards)
+def _all_customers_spend_rows() -> List[tuple]:
+    return _fetch_rows(sql.SQL("SELECT C.cust_id, COALESCE(S.order_count, 0), COALESCE(S.total_spent, 0.0), "
+                               "COALESCE(S.max_order_price, 0.0) "
+                               "FROM CUSTOMERS C "
+                               "LEFT OUTER JOIN CUSTOMERS_SPEND_SUMMARY S ON C.cust_id = S.cust_id"))
+
+
+@_profiled
+def get_customer_spend_stats(cust_ids: List[int]) -> List[Tuple[int, int, float, float, float]]:
+    # (cust_id, order_count, total_spent, max_order_price, average_order_price) of every existing customer of
+    # cust_ids, ordered by cust_id
+    if not cust_ids:
+        return []
+    try:
+        return [_spend_stats(row) for row in sorted(_customer_spend_rows(list(set(cust_ids))))]
+    except Exception as e:
+        return []
+
+
+@_profiled
+def get_all_customers_spend_stats() -> List[Tuple[int, int, float, float, float]]:
+    try:
+        return [_spend_stats(row) for row in sorted(_all_customers_spend_rows())]
+    except Exception as e:
+        return []
+
+
+# ---------------------------------- SALES SERIES API: ----------------------------------
+# SALES_PER_HOUR keeps the amount and profit sold of every dish per hour, maintained by the triggers created in
+# create_tables, so a series is aggregated from at most one row per dish and hour instead of the order lines.
+# a series has one (bucket start, value) entry per hour or day that overlaps [start, end), zero for empty buckets.
+# the table cannot tell the sales within an hour apart, so every bucket holds all of its hours: a start or end
+# inside a bucket widens the series to the whole bucket instead of leaving part of a labelled bucket out.
+# deleting an order takes its lines out of the buckets before the lines themselves are deleted by the cascade.
+
+_SERIES_STEPS = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+
+
+def _as_datetime(moment: date) -> datetime:
+    return moment if isinstance(moment, datetime) else datetime(moment.year, moment.month, moment.day)
+
+
+def _series_buckets(start: datetime, end: datetime, granularity: str) -> List[datetime]:
+    bucket = start.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'day':
+        bucket = bucket.replace(hour=0)
+    buckets = []
+    while bucket < end:
+        buckets.append(bucket)
+        bucket += _SERIES_STEPS[granularity]
+    return buckets
+
+
+@_sharded(_gather_from_all_shards)
+def _sales_series_rows(value_column: str, dish_id: int, start: datetime, end: datetime,
+                       granularity: str) -> List[tuple]:
+    # start and end are bucket boundaries
+    conditions = [sql.SQL("sales_hour >= {}").format(sql.Literal(start)),
+                  sql.SQL("sales_hour < {}").format(sql.Literal(end))]
+    if dish_id is not None:
+        conditions.append(sql.SQL("dish_id = {}").format(sql.Literal(dish_id)))
+    return _fetch_rows(sql.SQL("SELECT date_trunc({granularity}, sales_hour) AS bucket, SUM({value}) "
+                               "FROM SALES_PER_HOUR WHERE {conditions} "
+                               "GROUP BY bucket").format(granularity=sql.Literal(granularity),
+                                                         value=sql.Identifier(value_column),
+                                                         conditions=sql.SQL(" AND ").join(conditions)))
+
+
+@_profiled
+def get_profit_series(start: datetime, end: datetime, granularity: str = 'hour') -> List[Tuple[datetime, float]]:
+    if granularity not in _SERIES_STEPS:
+        return []
+    try:
+        buckets = _series_buckets(_as_datetime(start), _as_datetime(end), granularity)
+        if not buckets:
+            return []
+        profit = _sum_by_key(_sales_series_rows('profit', None, buckets[0], buckets[-1] + _SERIES_STEPS[granularity],
+                                                granularity))
+        return [(bucket, float(profit.get(bucket, 0.0))) for bucket in buckets]
+    except Exception as e:
+        return []
+
+
+@_profiled
+def get_dish_volume_series(dish_id: int, start: datetime, end: datetime,
+                           granularity: str = 'hour') -> List[Tuple[datetime, int]]:
+    if granularity not in _SERIES_STEPS:
+        return []
+    try:
+        buckets = _series_buckets(_as_datetime(start), _as_datetime(end), granularity)
+        if not buckets:
+            return []
+        volume = _sum_by_key(_sales_series_rows('amount', dish_id, buckets[0], buckets[-1] + _SERIES_STEPS[granularity],
+                                                granularity))
+        return [(bucket, int(volume.get(bucket, 0))) for bucket in buckets]
+    except Exception as e:
+        return []
+
+
+# ---------------------------------- EXPORT API: ----------------------------------
+# the exports stream COPY ... TO STDOUT straight into a file object, so they use constant memory whatever the
+# number of rows. orders and order lines are exported incrementally by change: inserting an order, changing its
+# dishes, placing it or deleting its customer stamps the order with the next value of ORDERS_CHANGE_SEQ, and
+# deleting it logs its order_id in ORDERS_DELETED with the next value. an export covers the stamps after since and
+# up to the watermark it returns, which is the since of the next export: every changed order is written again
+# with all its current dishes (a single row with empty dish columns when it has none), and every deleted order as
+# a row with deleted set and only its order_id, so the reader replaces or removes what it has for every order_id
+# it reads. the watermark is the last value of ORDERS_CHANGE_SEQ, read while holding exclusively the advisory lock
+# the stamping transactions hold shared, so no stamp at or below it can commit after it was read and it never
+# goes back. the watermark has one value per database (one per shard); an order moved to the shard of its
+# customer is exported by its new shard and is not logged as deleted by the old one.
+
+@_sharded(_route_copy)
+def _copy_to(file, query, binary: bool, header: bool) -> None:
+    conn = None
+    try:
+        conn = _new_connection()
+        options = sql.SQL("FORMAT binary") if binary else sql.SQL("FORMAT csv, HEADER {}").format(
+            sql.SQL("true" if header else "false"))
+        copy = sql.SQL("COPY ({}) TO STDOUT WITH ({})").format(query, options)
+        conn.cursor.copy_expert(copy.as_string(conn.connection), file)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def _latest_order_change() -> int:
+    return _fetch_rows(sql.SQL("SELECT pg_advisory_xact_lock(hashtext('ORDERS_CHANGE_SEQ')); "
+                               "SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM ORDERS_CHANGE_SEQ"))[0][0]
+
+
+def _copy_changed_orders(file, query: sql.SQL, since: int, binary: bool, header: bool) -> int:
+    until = _latest_order_change()
+    _copy_to(file, query.format(changed=sql.SQL("change_seq > {} AND change_seq <= {}").format(sql.Literal(since),
+                                                                                                sql.Literal(until))),
+             binary, header)
+    return until
+
+
+def _export_changed_orders(file, query: sql.SQL, since: Tuple[int, ...], binary: bool) -> Tuple[int, ...]:
+    databases = len(_shard_factories) or 1
+    since = since if since is not None else (0,) * databases
+    if len(since) != databases:
+        raise ValueError("the watermark was returned for another number of shards")
+    if binary and databases > 1:
+        raise ValueError("binary exports are not supported over shards")
+    if not _shard_factories:
+        return (_copy_changed_orders(file, query, since[0], binary, True),)
+    return tuple(_run_on_shard(shard, _copy_changed_orders, file, query, since[shard], binary, shard == 0)
+                 for shard in range(databases))
+
+
+@_profiled
+def export_orders(file, since: Tuple[int, ...] = None, binary: bool = False) -> Tuple[ReturnValue, Tuple[int, ...]]:
+    # writes (order_id, date, cust_id, deleted) rows, cust_id is empty for anonymous orders and only order_id is
+    # set for deleted orders. returns the result and the new watermark (since itself when the export failed)
+    try:
+        until = _export_changed_orders(file, sql.SQL("SELECT O.order_id, O.date, CPO.cust_id, FALSE AS deleted "
+                                                     "FROM ORDERS O "
+                                                     "LEFT OUTER JOIN CUSTOMERS_PLACE_ORDERS CPO "
+                                                     "ON O.order_id = CPO.order_id "
+                                                     "WHERE {changed} "
+                                                     "UNION ALL "
+                                                     "SELECT order_id, NULL, NULL, TRUE FROM ORDERS_DELETED "
+                                                     "WHERE {changed}"), since, binary)
+    except Exception as e:
+        return ReturnValue.ERROR, since
+    return ReturnValue.OK, until
+
+
+@_profiled
+def export_order_lines(file, since: Tuple[int, ...] = None,
+                       binary: bool = False) -> Tuple[ReturnValue, Tuple[int, ...]]:
+    # writes (order_id, date, cust_id, dish_id, amount, price, deleted) rows, price is the price frozen in the
+    # order. an order without dishes has one row with empty dish columns, a deleted order one with only order_id
+    try:
+        until = _export_changed_orders(file, sql.SQL("SELECT O.order_id, O.date, CPO.cust_id, "
+                                                     "DIO.dish_id, DIO.amount, DIO.price, FALSE AS deleted "
+                                                     "FROM ORDERS O "
+                                                     "LEFT OUTER JOIN DISHES_IN_ORDERS DIO "
+                                                     "ON O.order_id = DIO.order_id "
+                                                     "LEFT OUTER JOIN CUSTOMERS_PLACE_ORDERS CPO "
+                                                     "ON O.order_id = CPO.order_id "
+                                                     "WHERE {changed} "
+                                                     "UNION ALL "
+                                                     "SELECT order_id, NULL, NULL, NULL, NULL, NULL, TRUE "
+                                                     "FROM ORDERS_DELETED WHERE {changed}"), since, binary)
+    except Exception as e:
+        return ReturnValue.ERROR, since
+    return ReturnValue.OK, until
+
+
+@_profiled
+def export_likes(file, binary: bool = False) -> ReturnValue:
+    try:
+        _copy_to(file, sql.SQL("SELECT cust_id, dish_id FROM CUSTOMERS_LIKE_DISHES"), binary, True)
+    except Exception as e:
+        return ReturnValue.ERROR
+    return ReturnValue.OK
+
+
+# ---------------------------------- SEARCH API: ----------------------------------
+# substring search over names and phones. prefix matches are ranked before other matches and are looked up first
+# through the btree indexes; the other matches are only searched while there are fewer than limit prefix matches,
+# through the trigram GIN indexes when pg_trgm is available and by scanning the table otherwise.
+
+def _like_pattern(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _search_rank(row: tuple) -> tuple:
+    # rows start with (is_prefix, similarity, id)
+    return not row[0], -row[1], row[2]
+
+
+@_sharded(_gather_from_all_shards)
+def _search_customer_rows(query: str, limit: int) -> List[tuple]:
+    pattern = _like_pattern(query)
+    return _fetch_rows(sql.SQL("WITH PREFIX_MATCHES AS ("
+                               "SELECT TRUE AS is_prefix, GREATEST(SEARCH_SIMILARITY(full_name, {text}), "
+                               "SEARCH_SIMILARITY(phone, {text})) AS score, "
+                               "cust_id, full_name, phone, address FROM CUSTOMERS "
+                               "WHERE LOWER(full_name) LIKE {name_prefix} OR phone LIKE {prefix} "
+                               "ORDER BY score DESC, cust_id ASC LIMIT {limit}) "
+                               "SELECT * FROM PREFIX_MATCHES "
+                               "UNION ALL "
+                               "(SELECT FALSE, GREATEST(SEARCH_SIMILARITY(full_name, {text}), "
+                               "SEARCH_SIMILARITY(phone, {text})) AS score, "
+                               "cust_id, full_name, phone, address FROM CUSTOMERS "
+                               "WHERE (SELECT COUNT(*) FROM PREFIX_MATCHES) < {limit} "
+                               "AND (full_name ILIKE {contains} OR phone LIKE {contains}) "
+                               "AND NOT (LOWER(full_name) LIKE {name_prefix} OR phone LIKE {prefix}) "
+                               "ORDER BY score DESC, cust_id ASC "
+                               "LIMIT {limit})").format(contains=sql.Literal('%' + pattern + '%'),
+                                                        name_prefix=sql.Literal(pattern.lower() + '%'),
+                                                        prefix=sql.Literal(pattern + '%'),
+                                                        text=sql.Literal(query),
+                                                        limit=sql.Literal(limit)))
+
+
+@_sharded(_gather_from_all_shards)
+def _search_dish_rows(query: str, active_only: bool, limit: int) -> List[tuple]:
+    pattern = _like_pattern(query)
+    return _fetch_rows(sql.SQL("WITH PREFIX_MATCHES AS ("
+                               "SELECT TRUE AS is_prefix, SEARCH_SIMILARITY(name, {text}) AS score, "
+                               "dish_id, name, price, is_active FROM DISHES "
+                               "WHERE LOWER(name) LIKE {name_prefix} AND (is_active = TRUE OR NOT {active_only}) "
+                               "ORDER BY score DESC, dish_id ASC LIMIT {limit}) "
+                               "SELECT * FROM PREFIX_MATCHES "
+                               "UNION ALL "
+                               "(SELECT FALSE, SEARCH_SIMILARITY(name, {text}) AS score, "
+                               "dish_id, name, price, is_active FROM DISHES "
+                               "WHERE (SELECT COUNT(*) FROM PREFIX_MATCHES) < {limit} "
+                               "AND name ILIKE {contains} AND NOT LOWER(name) LIKE {name_prefix} "
+                               "AND (is_active = TRUE OR NOT {active_only}) "
+                               "ORDER BY score DESC, dish_id ASC "
+                               "LIMIT {limit})").format(contains=sql.Literal('%' + pattern + '%'),
+                                                        active_only=sql.Literal(active_only),
+                                                        name_prefix=sql.Literal(pattern.lower() + '%'),
+                                                        text=sql.Literal(query),
+                                                        limit=sql.Literal(limit)))
+
+
+@_profiled
+def search_customers(query: str, limit: int = 20) -> List[Customer]:
+    if not query:
+        return []
+    try:
+        rows = sorted(_search_customer_rows(query, limit), key=_search_rank)[:limit]
+        return [Customer(cust_id, full_name, phone, address) for _, _, cust_id, full_name, phone, address in rows]
+    except Exception as e:
+        return []
+
+
+@_profiled
+def search_dishes(query: str, active_only: bool = False, limit: int = 20) -> List[Dish]:
+    if not query:
+        return []
+    try:
+        rows = sorted(_search_dish_rows(query, active_only, limit), key=_search_rank)
+        # the menu is replicated, so every shard returns the same dishes
+        rows = list(OrderedDict(((row[2], row) for row in rows)).values())[:limit]
+        return [Dish(dish_id, name, float(price), is_active) for _, _, dish_id, name, price, is_active in rows]
+    except Exception as e:
+        return []
+
+
+# ---------------------------------- PARALLEL API: ----------------------------------
+# independent API calls (e.g. the tiles of a dashboard) run at the same time on a thread pool. every API
+# function opens its own connection, so the calls never share a session and the wall time is close to the
+# slowest single call instead of the sum of all of them. the connections a call opens are tracked, so a call
+# that times out or is cancelled has its running query cancelled on the server, and it cannot open new ones.
+
+_PARALLEL_POLL_INTERVAL = 0.05
+
+_parallel_local = threading.local()
+
+
+class ParallelCallFailed(Exception):
+    # the result of a run_parallel call that raised (error is the exception), timed out or was cancelled
+    def __init__(self, reason: str, error: Exception = None):
+        super().__init__(reason if error is None else "{}: {!r}".format(reason, error))
+        self.reason = reason
+        self.error = error
+
+
+def _call_failed(result) -> bool:
+    return isinstance(result, ParallelCallFailed)
+
+
+class _ParallelCall:
+    # the connections opened by one call of run_parallel, including the calls of the run_parallel it makes
+    def __init__(self, parent=None):
+        self._lock = threading.Lock()
+        self.connections = []
+        self.children = []
+        self.cancelled = False
+        if parent is not None:
+            with parent._lock:
+                parent.children.append(self)
+                self.cancelled = parent.cancelled
+
+    def opened(self, conn) -> None:
+        with self._lock:
+            if not self.cancelled:
+                self.connections.append(conn)
+                return
+        _close_quietly(conn)
+        raise DatabaseException.ConnectionInvalid("the call was cancelled")
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            connections, children = list(self.connections), list(self.children)
+        for conn in connections:
+            try:
+                # psycopg2 cancels the query running on the connection from any thread
+                conn.connection.cancel()
+            except Exception as e:
+                pass
+        for child in children:
+            child.cancel()
+
+
+def _timed_call(started: Dict[int, float], index: int, call: _ParallelCall, func, args: tuple,
+                profile_stack: tuple):
+    started[index] = time.monotonic()
+    # the profiler frames of the call are nested under the frame that called run_parallel
+    _profile_local.base = profile_stack
+    _parallel_local.call = call
+    try:
+        return func(*args)
+    finally:
+        _profile_local.base = ()
+        _parallel_local.call = None
+
+
+@_profiled
+def run_parallel(calls: List, timeout: float = None, max_workers: int = None,
+                 cancel: threading.Event = None) -> List:
+    # every call is either a function or a tuple (function, arg1, arg2, ...). the results are returned in the
+    # order of the calls; a call that raised, ran longer than timeout seconds (counted from its own start) or
+    # was cancelled through the cancel event returns a ParallelCallFailed. calls that did not start yet are not
+    # run, and the queries of the calls that are already running are cancelled.
+    calls = [call if isinstance(call, tuple) else (call,) for call in calls]
+    if not calls:
+        return []
+    parent = getattr(_parallel_local, 'call', None)
+    states = [_ParallelCall(parent) for _ in calls]
+    results = [ParallelCallFailed('cancelled') for _ in calls]
+    started = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(calls))
+    pending = set()
+    try:
+        profile_stack = _profile_stack()
+        futures = {executor.submit(_timed_call, started, index, states[index], call[0], call[1:], profile_stack):
+                   index for index, call in enumerate(calls)}
+        pending = set(futures)
+        while pending:
+            if cancel is not None and cancel.is_set():
+                break
+            wait_for = None
+            if timeout is not None:
+                now = time.monotonic()
+                for future in list(pending):
+                    index = futures[future]
+                    if index in started and now - started[index] >= timeout:
+                        future.cancel()
+                        pending.discard(future)
+                        states[index].cancel()
+                        results[index] = ParallelCallFailed('timeout')
+                deadlines = [started[futures[future]] + timeout for future in pending if futures[future] in started]
+                wait_for = max(min(deadlines) - now, 0) if deadlines else timeout
+            if cancel is not None:
+                wait_for = _PARALLEL_POLL_INTERVAL if wait_for is None else min(wait_for, _PARALLEL_POLL_INTERVAL)
+            done, _ = _profiled_wait(wait, pending, wait_for, FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                error = future.exception()
+                results[futures[future]] = future.result() if error is None else ParallelCallFailed('error', error)
+        return results
+    finally:
+        for future in pending:
+            future.cancel()
+            states[futures[future]].cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ---------------------------------- LIKES BUFFER: ----------------------------------
+# in buffered mode customer_likes_dish / customer_dislike_dish only queue the event and return OK. the queue is
+# flushed when it reaches max_events or max_delay seconds after its first event: the events are replayed per
+# (cust_id, dish_id) against the current likes, so a like -> dislike -> like burst costs a single INSERT, and
+# the net changes are written with one batched INSERT and one batched DELETE. the ReturnValue every event would
+# have got from the unbuffered API is reported by flush_likes_buffer(), which keeps the outcomes of the last
+# max_outcomes events when nobody collects them.
+
+_likes_lock = threading.Lock()
+_likes_flush_lock = threading.Lock()
+_likes_buffering = False
+_likes_max_events = 500
+_likes_max_delay = 1.0
+_likes_events = []
+_likes_outcomes = deque(maxlen=10000)
+_likes_timer = None
+
+
+def _buffer_like_event(cust_id: int, dish_id: int, liked: bool) -> ReturnValue:
+    global _likes_timer
+    with _likes_lock:
+        _likes_events.append((cust_id, dish_id, liked))
+        size_reached = len(_likes_events) >= _likes_max_events
+        if not size_reached and _likes_timer is None:
+            _likes_timer = threading.Timer(_likes_max_delay, _flush_pending_likes)
+            _likes_timer.daemon = True
+            _likes_timer.start()
+    if size_reached:
+        _flush_pending_likes()
+    return ReturnValue.OK
+
+
+def _rejected_like_key(cust_id, dish_id):
+    # ids the database would reject without looking at any row are answered here, so they cannot fail the
+    # query of the whole batch
+    for key in (cust_id, dish_id):
+        if key is None:
+            return ReturnValue.NOT_EXISTS
+        if not isinstance(key, int) or isinstance(key, bool):
+            # the unbuffered statement fails on an id like 'x' that is not an integer
+            return ReturnValue.ERROR
+        if key <= 0:
+            return ReturnValue.NOT_EXISTS
+    return None
+
+
+@_sharded(_route_likes_events)
+def _write_likes_events(events: List[Tuple[int, int, bool]]) -> List[Tuple[int, int, bool, ReturnValue]]:
+    rejected = {(cust_id, dish_id): _rejected_like_key(cust_id, dish_id) for cust_id, dish_id, _ in events}
+    keys = [key for key in OrderedDict.fromkeys((cust_id, dish_id) for cust_id, dish_id, _ in events)
+            if rejected[key] is None]
+    conn = None
+    try:
+        is_valid = {}
+        initially_liked = {}
+        if keys:
+            conn = _new_connection()
+            query = sql.SQL("SELECT V.cust_id, V.dish_id, "
+                            "EXISTS(SELECT 1 FROM CUSTOMERS C WHERE C.cust_id = V.cust_id) "
+                            "AND EXISTS(SELECT 1 FROM DISHES D WHERE D.dish_id = V.dish_id) AS is_valid, "
+                            "EXISTS(SELECT 1 FROM CUSTOMERS_LIKE_DISHES CLD "
+                            "WHERE CLD.cust_id = V.cust_id AND CLD.dish_id = V.dish_id) AS is_liked "
+                            "FROM (VALUES {}) AS V(cust_id, dish_id)").format(
+                sql.SQL(", ").join(sql.SQL("({}, {})").format(sql.Literal(cust_id), sql.Literal(dish_id))
+                                   for cust_id, dish_id in keys))
+            _, res = conn.execute(query)
+            is_valid = {(row[0], row[1]): row[2] for row in res.rows}
+            initially_liked = {(row[0], row[1]): row[3] for row in res.rows}
+        currently_liked = dict(initially_liked)
+        outcomes = []
+        for cust_id, dish_id, liked in events:
+            key = (cust_id, dish_id)
+            if rejected[key] is not None:
+                result = rejected[key]
+            elif not is_valid[key]:
+                result = ReturnValue.NOT_EXISTS
+            elif currently_liked[key] == liked:
+                # liking a liked dish / disliking a dish that is not liked, as the unbuffered API reports it
+                result = ReturnValue.ALREADY_EXISTS if liked else ReturnValue.NOT_EXISTS
+            else:
+                currently_liked[key] = liked
+                result = ReturnValue.OK
+            outcomes.append((cust_id, dish_id, liked, result))
+        to_insert = [key for key in keys if currently_liked[key] and not initially_liked[key]]
+        to_delete = [key for key in keys if initially_liked[key] and not currently_liked[key]]
+        statements = []
+        if to_insert:
+            statements.append(sql.SQL("INSERT INTO CUSTOMERS_LIKE_DISHES(cust_id, dish_id) VALUES {} "
+                                      "ON CONFLICT DO NOTHING;").format(
+                sql.SQL(", ").join(sql.SQL("({}, {})").format(sql.Literal(cust_id), sql.Literal(dish_id))
+                                   for cust_id, dish_id in to_insert)))
+        if to_delete:
+            statements.append(sql.SQL("DELETE FROM CUSTOMERS_LIKE_DISHES WHERE (cust_id, dish_id) IN "
+                                      "(VALUES {});").format(
+                sql.SQL(", ").join(sql.SQL("({}, {})").format(sql.Literal(cust_id), sql.Literal(dish_id))
+                                   for cust_id, dish_id in to_delete)))
+        if statements:
+            conn.execute(sql.SQL(" ").join(statements))
+            _bump_table_versions('CUSTOMERS_LIKE_DISHES')
+        return outcomes
+    except Exception as e:
+        return [(cust_id, dish_id, liked, rejected[(cust_id, dish_id)] or ReturnValue.ERROR)
+                for cust_id, dish_id, liked in events]
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def _flush_pending_likes() -> None:
+    global _likes_timer
+    # flushes are serialized so the events of one (cust_id, dish_id) are always written in arrival order
+    with _likes_flush_lock:
+        with _likes_lock:
+            events = list(_likes_events)
+            _likes_events.clear()
+            if _likes_timer is not None:
+                _likes_timer.cancel()
+                _likes_timer = None
+        if events:
+            # a flush triggered by a like runs inside the shard of its customer, but the events of the batch
+            # belong to the shards of their own customers
+            outcomes = _run_outside_shards(_write_likes_events, events)
+            with _likes_lock:
+                _likes_outcomes.extend(outcomes)
+
+
+def enable_likes_buffer(max_events: int = 500, max_delay: float = 1.0, max_outcomes: int = 10000) -> None:
+    global _likes_buffering, _likes_max_events, _likes_max_delay, _likes_outcomes
+    with _likes_lock:
+        _likes_max_events = max_events
+        _likes_max_delay = max_delay
+        _likes_outcomes = deque(_likes_outcomes, maxlen=max_outcomes)
+        _likes_buffering = True
+
+
+@_profiled
+def flush_likes_buffer() -> List[Tuple[int, int, bool, ReturnValue]]:
+    # writes the queued events synchronously and returns (cust_id, dish_id, liked, result) for every event
+    # flushed since the previous call (at most the last max_outcomes of them), in arrival order
+    _flush_pending_likes()
+    with _likes_lock:
+        outcomes = list(_likes_outcomes)
+        _likes_outcomes.clear()
+    return outcomes
+
+
+@_profiled
+def disable_likes_buffer() -> List[Tuple[int, int, bool, ReturnValue]]:
+    global _likes_buffering
+    with _likes_lock:
+        _likes_buffering = False
+    return flush_likes_buffer()
+
+
+# ---------------------------------- CHANGE FEED: ----------------------------------
+# the statement triggers created in create_tables publish one message per statement that changed a table on the
+# table_changes channel: 'TABLE:key' when it changed a single row of CUSTOMERS, ORDERS or DISHES, 'TABLE' for the
+# other statements and for the relation tables. the columns kept by the triggers themselves (ORDERS.change_seq,
+# CUSTOMERS_PLACE_ORDERS.order_price) are not announced, and PostgreSQL delivers the same message only once per
+# transaction, so an API write sends one message per table it changed. the listener keeps a dedicated connection
+# LISTENing on that channel, bumps the query cache versions of the changed table and passes the change to the
+# registered callbacks, so every node invalidates its local caches whoever made the change. a dropped connection
+# is opened again with exponential backoff. while it is down the changes of its database are unknown, so the
+# query cache is bypassed, and everything is invalidated once it listens again. the query cache is bypassed as
+# well until the listener has been started.
+
+CHANGE_CHANNEL = 'table_changes'
+
+_LISTENER_POLL_INTERVAL = 0.5
+_LISTENER_MIN_BACKOFF = 0.5
+_LISTENER_MAX_BACKOFF = 30.0
+
+_listener_lock = threading.Lock()
+_listener_threads = []
+_listener_stop = threading.Event()
+_listeners_down = set()
+_change_callbacks = []
+
+
+def _change_feed_live() -> bool:
+    # a listener that was never started counts as down, like one that is reconnecting
+    with _listener_lock:
+        return bool(_listener_threads) and not _listeners_down and \
+            all(thread.is_alive() for thread in _listener_threads)
+
+
+def register_change_callback(callback) -> None:
+    # callback(table, key) - key is the changed id, or None when only the table is known
+    with _listener_lock:
+        _change_callbacks.append(callback)
+
+
+def unregister_change_callback(callback) -> None:
+    with _listener_lock:
+        if callback in _change_callbacks:
+            _change_callbacks.remove(callback)
+
+
+def _apply_change(table: str, key: int = None) -> None:
+    _bump_table_versions(table)
+    with _listener_lock:
+        callbacks = list(_change_callbacks)
+    for callback in callbacks:
+        try:
+            callback(table, key)
+        except Exception as e:
+            pass
+
+
+def _invalidate_all_tables() -> None:
+    for table in _ALL_TABLES:
+        _apply_change(table)
+
+
+def _open_listener(factory):
+    conn = factory()
+    try:
+        conn.connection.autocommit = True
+        conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(CHANGE_CHANNEL)))
+    except Exception as e:
+        conn.close()
+        raise
+    return conn
+
+
+def _close_listener(conn) -> None:
+    try:
+        conn.close()
+    except Exception as e:
+        pass
+
+
+def _listen_for_changes(database: int, factory, conn, stop: threading.Event) -> None:
+    backoff = _LISTENER_MIN_BACKOFF
+    while not stop.is_set():
+        try:
+            if conn is None:
+                conn = _open_listener(factory)
+                # changes may have been missed while the connection was down
+                _invalidate_all_tables()
+                with _listener_lock:
+                    _listeners_down.discard(database)
+                backoff = _LISTENER_MIN_BACKOFF
+            if select.select([conn.connection], [], [], _LISTENER_POLL_INTERVAL) == ([], [], []):
+                continue
+            conn.connection.poll()
+            while conn.connection.notifies:
+                table, _, key = conn.connection.notifies.pop(0).payload.partition(':')
+                _apply_change(table, int(key) if key else None)
+        except Exception as e:
+            with _listener_lock:
+                _listeners_down.add(database)
+            _invalidate_all_tables()
+            if conn is not None:
+                _close_listener(conn)
+                conn = None
+            stop.wait(backoff)
+            backoff = min(backoff * 2, _LISTENER_MAX_BACKOFF)
+    if conn is not None:
+        _close_listener(conn)
+
+
+def start_change_listener() -> ReturnValue:
+    # one listening connection per shard, since every shard publishes the changes of its own rows
+    global _listener_threads, _listener_stop
+    with _listener_lock:
+        if _listener_threads and all(thread.is_alive() for thread in _listener_threads):
+            return ReturnValue.OK
+    # listeners that are left over from a previous start are replaced together
+    stop_change_listener()
+    with _listener_lock:
+        if _listener_threads:
+            return ReturnValue.OK
+        factories = _shard_factories or [Connector.DBConnector]
+        connections = []
+        try:
+            for factory in factories:
+                connections.append(_open_listener(factory))
+        except Exception as e:
+            for conn in connections:
+                _close_listener(conn)
+            return ReturnValue.ERROR
+        _listener_stop = threading.Event()
+        _listener_threads = [threading.Thread(target=_listen_for_changes,
+                                              args=(database, factory, conn, _listener_stop), daemon=True)
+                             for database, (factory, conn) in enumerate(zip(factories, connections))]
+        for thread in _listener_threads:
+            thread.start()
+    # entries cached before the listener started may already miss changes made by other nodes
+    _invalidate_all_tables()
+    return ReturnValue.OK
+
+
+def stop_change_listener() -> None:
+    global _listener_threads
+    with _listener_lock:
+        threads, _listener_threads = _listener_threads, []
+        _listener_stop.set()
+    for thread in threads:
+        thread.join()
+    with _listener_lock:
+        _listeners_down.clear()
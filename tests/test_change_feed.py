@@ -0,0 +1,79 @@
+import queue
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+try:
+    import psycopg2
+    import Solution
+    from Utility.ReturnValue import ReturnValue
+    from Business.Dish import Dish
+    from Business.Order import Order
+    from test_sharding import SHARD_DSNS, _Connector, _factory
+except ImportError:
+    psycopg2 = None
+
+# the change listener against a real database, written to by a second connection as another node would. it uses
+# the first of the DSNs in SOLUTION_SHARD_DSNS (see test_sharding.py).
+
+_WAIT = 5.0
+
+
+@unittest.skipIf(psycopg2 is None or not SHARD_DSNS, "needs psycopg2 and SOLUTION_SHARD_DSNS")
+class ChangeFeedTest(unittest.TestCase):
+    def setUp(self):
+        Solution.clear_shards()
+        patch = mock.patch.object(Solution.Connector, 'DBConnector', _factory(SHARD_DSNS[0]))
+        patch.start()
+        self.addCleanup(patch.stop)
+        Solution.drop_tables()
+        Solution.create_tables()
+        self.addCleanup(Solution.drop_tables)
+        Solution.clear_query_cache()
+        self.addCleanup(Solution.clear_query_cache)
+        self.changes = queue.Queue()
+        Solution.register_change_callback(self._record_change)
+        self.addCleanup(Solution.unregister_change_callback, self._record_change)
+        self.assertEqual(Solution.start_change_listener(), ReturnValue.OK)
+        self.addCleanup(Solution.stop_change_listener)
+        # starting the listener invalidates every table
+        while not self.changes.empty():
+            self.changes.get_nowait()
+        self.other_node = _Connector(SHARD_DSNS[0])
+        self.addCleanup(self.other_node.close)
+
+    def _record_change(self, table, key):
+        self.changes.put((table, key))
+
+    def _changes(self, count):
+        # the first count changes, and whatever else arrives shortly after them
+        changes = [self.changes.get(timeout=_WAIT) for _ in range(count)]
+        time.sleep(2 * Solution._LISTENER_POLL_INTERVAL)
+        while not self.changes.empty():
+            changes.append(self.changes.get_nowait())
+        return changes
+
+    def test_write_of_another_node_invalidates_the_cache(self):
+        Solution.add_dish(Dish(1, 'Pizza', 10.0, True))
+        Solution.add_order(Order(1, datetime(2024, 5, 1, 12)))
+        self.assertEqual(sorted(self._changes(2)), [('DISHES', 1), ('ORDERS', 1)])
+        self.assertTrue(Solution._change_feed_live())
+        self.assertEqual(dict(Solution.get_total_profit_per_month(2024))[5], 0.0)
+        Solution.get_total_profit_per_month(2024)
+        self.assertEqual(Solution.get_query_cache_stats()['hits'], 1)
+
+        self.other_node.execute("INSERT INTO DISHES_IN_ORDERS(order_id, dish_id, amount, price) VALUES (1, 1, 2, 10)")
+        # the order is stamped for the export, which is not announced
+        self.assertEqual(self._changes(1), [('DISHES_IN_ORDERS', None)])
+        self.assertEqual(dict(Solution.get_total_profit_per_month(2024))[5], 20.0)
+        self.assertEqual(Solution.get_query_cache_stats()['misses'], 2)
+
+    def test_one_message_per_changed_table(self):
+        for order_id in (1, 2, 3):
+            Solution.add_order(Order(order_id, datetime(2024, 5, 1, 12)))
+        self._changes(3)
+        self.other_node.execute("UPDATE ORDERS SET date = date + INTERVAL '1 hour' WHERE order_id = 2")
+        self.assertEqual(self._changes(1), [('ORDERS', 2)])
+        self.other_node.execute("DELETE FROM ORDERS")
+        self.assertEqual(self._changes(1), [('ORDERS', None)])
@@ -0,0 +1,114 @@
+import re
+import unittest
+from unittest import mock
+
+try:
+    from psycopg2 import sql
+    import Solution
+    from Utility.ReturnValue import ReturnValue
+except ImportError:
+    Solution = None
+
+# the likes buffer over a stub connection that answers the lookup of a flush from a small in-memory database
+# and records the statements it writes, so no database is needed.
+
+
+def _render(query):
+    if isinstance(query, str):
+        return query
+    if isinstance(query, sql.Composed):
+        return ''.join(_render(part) for part in query.seq)
+    if isinstance(query, sql.Literal):
+        return repr(query.wrapped)
+    return query.string
+
+
+class _ResultSet:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class _StubConnector:
+    customers = {1, 2}
+    dishes = {1, 2, 3}
+    likes = set()
+    writes = []
+
+    def __init__(self):
+        self.connection = None
+
+    def execute(self, query, printSchema=False):
+        text = _render(query)
+        if text.startswith('SELECT'):
+            keys = [(int(cust_id), int(dish_id)) for cust_id, dish_id in re.findall(r"\((\d+), (\d+)\)", text)]
+            return len(keys), _ResultSet([(cust_id, dish_id,
+                                           cust_id in self.customers and dish_id in self.dishes,
+                                           (cust_id, dish_id) in self.likes) for cust_id, dish_id in keys])
+        _StubConnector.writes.append(text)
+        return 1, _ResultSet([])
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(Solution is None, "needs psycopg2 and the Business and Utility packages")
+class LikesBufferTest(unittest.TestCase):
+    def setUp(self):
+        _StubConnector.likes = {(2, 2)}
+        _StubConnector.writes = []
+        patch = mock.patch.object(Solution.Connector, 'DBConnector', _StubConnector)
+        patch.start()
+        self.addCleanup(patch.stop)
+        Solution.enable_likes_buffer(max_events=100, max_delay=60.0)
+        self.addCleanup(Solution.disable_likes_buffer)
+
+    def test_burst_writes_a_single_insert(self):
+        self.assertEqual(Solution.customer_likes_dish(1, 1), ReturnValue.OK)
+        self.assertEqual(Solution.customer_dislike_dish(1, 1), ReturnValue.OK)
+        self.assertEqual(Solution.customer_likes_dish(1, 1), ReturnValue.OK)
+        self.assertEqual(_StubConnector.writes, [])
+        self.assertEqual(Solution.flush_likes_buffer(), [(1, 1, True, ReturnValue.OK), (1, 1, False, ReturnValue.OK),
+                                                         (1, 1, True, ReturnValue.OK)])
+        self.assertEqual(len(_StubConnector.writes), 1)
+        self.assertEqual(_StubConnector.writes[0].count('INSERT'), 1)
+        self.assertNotIn('DELETE', _StubConnector.writes[0])
+        self.assertIn('(1, 1)', _StubConnector.writes[0])
+
+    def test_burst_back_to_the_start_writes_nothing(self):
+        Solution.customer_dislike_dish(2, 2)
+        Solution.customer_likes_dish(2, 2)
+        self.assertEqual([outcome[3] for outcome in Solution.flush_likes_buffer()], [ReturnValue.OK] * 2)
+        self.assertEqual(_StubConnector.writes, [])
+
+    def test_outcomes_match_the_unbuffered_api(self):
+        events = [(1, 3, False), (2, 2, True), (9, 1, True), (1, 9, True), (0, 1, True), (1, -2, False),
+                  (None, 1, True), ('x', 1, True), (1, True, False), (2, 1, True), (2, 2, False)]
+        for cust_id, dish_id, liked in events:
+            if liked:
+                Solution.customer_likes_dish(cust_id, dish_id)
+            else:
+                Solution.customer_dislike_dish(cust_id, dish_id)
+        results = [ReturnValue.NOT_EXISTS, ReturnValue.ALREADY_EXISTS, ReturnValue.NOT_EXISTS,
+                   ReturnValue.NOT_EXISTS, ReturnValue.NOT_EXISTS, ReturnValue.NOT_EXISTS, ReturnValue.NOT_EXISTS,
+                   ReturnValue.ERROR, ReturnValue.ERROR, ReturnValue.OK, ReturnValue.OK]
+        self.assertEqual(Solution.flush_likes_buffer(),
+                         [event + (result,) for event, result in zip(events, results)])
+        self.assertEqual(len(_StubConnector.writes), 1)
+        self.assertIn('INSERT', _StubConnector.writes[0])
+        self.assertIn('DELETE', _StubConnector.writes[0])
+
+    def test_failed_write_reports_error_for_the_valid_events(self):
+        with mock.patch.object(_StubConnector, 'execute', side_effect=Exception('connection lost')):
+            Solution.customer_likes_dish(1, 1)
+            Solution.customer_likes_dish('x', 1)
+            Solution.customer_likes_dish(0, 1)
+            self.assertEqual([outcome[3] for outcome in Solution.flush_likes_buffer()],
+                             [ReturnValue.ERROR, ReturnValue.ERROR, ReturnValue.NOT_EXISTS])
+
+    def test_size_triggers_the_flush(self):
+        Solution.enable_likes_buffer(max_events=2, max_delay=60.0)
+        Solution.customer_likes_dish(1, 1)
+        self.assertEqual(_StubConnector.writes, [])
+        Solution.customer_likes_dish(1, 2)
+        self.assertEqual(len(_StubConnector.writes), 1)
+        self.assertEqual(len(Solution.flush_likes_buffer()), 2)
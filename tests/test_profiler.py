@@ -0,0 +1,133 @@
+import io
+import re
+import time
+import unittest
+from unittest import mock
+
+try:
+    import Solution
+except ImportError:
+    Solution = None
+
+# the profiler over a stub connector whose connect, query round trip, result building and COPY take known times,
+# so no database is needed. the timings are only checked from below, as a loaded machine only makes them longer.
+
+_CONNECT = 0.01
+_ROUND_TRIP = 0.03
+_TRANSFER = 0.02
+
+
+class _ResultSet:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class _StubCursor:
+    def __init__(self):
+        self.rowcount = -1
+
+    def execute(self, query):
+        time.sleep(_ROUND_TRIP)
+        self.rowcount = 1
+
+    def copy_expert(self, query, file):
+        time.sleep(_ROUND_TRIP)
+        for row in ('1,1\n', '1,2\n', '2,1\n'):
+            file.write(row if isinstance(file, io.TextIOBase) else row.encode())
+        self.rowcount = 3
+
+
+class _SlowStringIO(io.StringIO):
+    # writing the COPY rows into the file is the transfer of an export
+    def write(self, data):
+        time.sleep(_TRANSFER / 3)
+        return super().write(data)
+
+
+class _SlowBytesIO(io.BytesIO):
+    def write(self, data):
+        time.sleep(_TRANSFER / 3)
+        return super().write(data)
+
+
+class _StubConnector:
+    # runs the query on its cursor and then builds the result set, like DBConnector
+    def __init__(self):
+        time.sleep(_CONNECT)
+        self.connection = mock.Mock()
+        self.cursor = _StubCursor()
+
+    def execute(self, query, printSchema=False):
+        self.cursor.execute(query)
+        time.sleep(_TRANSFER)
+        return 1, _ResultSet([(1, 'Alice Cohen', '0501111111', 'Haifa 1')])
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(Solution is None, "needs the Business and Utility packages")
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(Solution.Connector, 'DBConnector', _StubConnector)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _entries(self, profile):
+        return {stack: (calls, round_trips, rows, phases) for stack, calls, round_trips, rows, phases
+                in profile.report()}
+
+    def test_phases_of_a_query(self):
+        with Solution.profile_queries() as profile:
+            self.assertEqual(Solution.get_customer(1).get_full_name(), 'Alice Cohen')
+        calls, round_trips, rows, phases = self._entries(profile)['get_customer']
+        self.assertEqual((calls, round_trips, rows), (1, 1, 1))
+        self.assertEqual(set(phases), set(Solution.PROFILE_PHASES))
+        self.assertGreaterEqual(phases['connect'], _CONNECT)
+        self.assertGreaterEqual(phases['execute'], _ROUND_TRIP)
+        self.assertGreaterEqual(phases['transfer'], _TRANSFER)
+        self.assertEqual(phases['wait'], 0.0)
+        self.assertEqual(profile.phase_totals(), phases)
+
+    def test_calls_outside_the_profile_are_not_recorded(self):
+        with Solution.profile_queries() as profile:
+            pass
+        Solution.get_customer(1)
+        self.assertEqual(profile.report(), [])
+
+    def test_copy_round_trip(self):
+        for file in (_SlowStringIO(), _SlowBytesIO()):
+            with Solution.profile_queries() as profile:
+                self.assertEqual(Solution.export_likes(file), Solution.ReturnValue.OK)
+            self.assertEqual(len(file.getvalue()), 12)
+            calls, round_trips, rows, phases = self._entries(profile)['export_likes']
+            self.assertEqual((calls, round_trips, rows), (1, 1, 3))
+            self.assertGreaterEqual(phases['execute'], _ROUND_TRIP)
+            self.assertGreaterEqual(phases['transfer'], _TRANSFER)
+
+    def test_parallel_calls_nest_under_run_parallel(self):
+        with Solution.profile_queries() as profile:
+            customers = Solution.run_parallel([(Solution.get_customer, 1), (Solution.get_customer, 2)])
+        self.assertEqual([customer.get_cust_id() for customer in customers], [1, 1])
+        entries = self._entries(profile)
+        self.assertEqual(set(entries), {'run_parallel', 'run_parallel;get_customer'})
+        calls, round_trips, rows, phases = entries['run_parallel;get_customer']
+        self.assertEqual((calls, round_trips, rows), (2, 2, 2))
+        calls, round_trips, rows, phases = entries['run_parallel']
+        self.assertEqual((calls, round_trips), (1, 0))
+        # run_parallel spends its time waiting for the calls
+        self.assertGreaterEqual(phases['wait'], _CONNECT + _ROUND_TRIP + _TRANSFER)
+
+    def test_dump_folded(self):
+        with Solution.profile_queries() as profile:
+            Solution.run_parallel([(Solution.get_customer, 1)])
+            Solution.export_likes(io.StringIO())
+        folded = io.StringIO()
+        profile.dump_folded(folded)
+        lines = folded.getvalue().splitlines()
+        self.assertTrue(all(re.fullmatch(r"[\w;]+ \d+", line) for line in lines), lines)
+        expected = {(stack, phase) for stack, _, _, _, phases in profile.report()
+                    for phase, seconds in phases.items() if seconds > 0}
+        self.assertEqual(sorted(tuple(line.split(' ')[0].rsplit(';', 1)) for line in lines), sorted(expected))
+        self.assertIn(('run_parallel;get_customer', 'execute'), expected)
+        self.assertIn(('export_likes', 'transfer'), expected)
@@ -0,0 +1,121 @@
+import unittest
+from unittest import mock
+
+try:
+    import Solution
+except ImportError:
+    Solution = None
+
+# the query cache over a stub connection, so no database is needed. the change feed is reported as live, since
+# the cache is only used while the listeners run.
+
+
+class _ResultSet:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class _StubConnector:
+    # answers every query with the same rows, or raises when fail is set
+    queries = []
+    fail = False
+
+    def __init__(self):
+        self.connection = None
+
+    def execute(self, query, printSchema=False):
+        _StubConnector.queries.append(query)
+        if _StubConnector.fail:
+            raise Exception('connection lost')
+        return 1, _ResultSet([(1, 10.0)])
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(Solution is None, "needs the Business and Utility packages")
+class QueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        _StubConnector.queries = []
+        _StubConnector.fail = False
+        Solution.clear_query_cache()
+        self.addCleanup(Solution.clear_query_cache)
+        self._feed_live = Solution._change_feed_live
+        for patch in (mock.patch.object(Solution.Connector, 'DBConnector', _StubConnector),
+                      mock.patch.object(Solution, '_change_feed_live', return_value=True)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _profit(self, *args, **kwargs):
+        return Solution.get_total_profit_per_month(*args, **kwargs)
+
+    def test_hit_after_miss(self):
+        self.assertEqual(self._profit(2024), [(1, 10.0)])
+        self.assertEqual(self._profit(2024), [(1, 10.0)])
+        self.assertEqual(len(_StubConnector.queries), 1)
+        stats = Solution.get_query_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 1, 1))
+
+    def test_other_arguments_miss(self):
+        self._profit(2024)
+        self._profit(2023)
+        self.assertEqual(len(_StubConnector.queries), 2)
+
+    def test_keyword_call_hits_positional_entry(self):
+        self._profit(2024)
+        self._profit(year=2024)
+        self.assertEqual(len(_StubConnector.queries), 1)
+
+    def test_cached_list_is_a_copy(self):
+        self._profit(2024).append((2, 0.0))
+        self.assertEqual(self._profit(2024), [(1, 10.0)])
+
+    def test_least_recently_used_is_evicted(self):
+        with mock.patch.object(Solution, 'QUERY_CACHE_MAX_ENTRIES', 2):
+            self._profit(2020)
+            self._profit(2021)
+            self._profit(2020)
+            self._profit(2022)
+            self.assertEqual(Solution.get_query_cache_stats()['evictions'], 1)
+            self.assertEqual(Solution.get_query_cache_stats()['entries'], 2)
+            self._profit(2020)
+            self._profit(2022)
+            self.assertEqual(len(_StubConnector.queries), 3)
+            self._profit(2021)
+            self.assertEqual(len(_StubConnector.queries), 4)
+
+    def test_failed_result_is_not_cached(self):
+        _StubConnector.fail = True
+        self.assertEqual(self._profit(2024), [])
+        self.assertEqual(Solution.get_query_cache_stats()['entries'], 0)
+        _StubConnector.fail = False
+        self.assertEqual(self._profit(2024), [(1, 10.0)])
+        self.assertEqual(len(_StubConnector.queries), 2)
+
+    def test_table_change_invalidates_entry(self):
+        self._profit(2024)
+        Solution._bump_table_versions('DISHES')
+        self._profit(2024)
+        self.assertEqual(len(_StubConnector.queries), 1)
+        Solution._bump_table_versions('ORDERS')
+        self._profit(2024)
+        self.assertEqual(len(_StubConnector.queries), 2)
+
+    def test_bypassed_without_change_feed(self):
+        with mock.patch.object(Solution, '_change_feed_live', return_value=False):
+            self._profit(2024)
+            self._profit(2024)
+        self.assertEqual(len(_StubConnector.queries), 2)
+        stats = Solution.get_query_cache_stats()
+        self.assertEqual((stats['bypasses'], stats['entries']), (2, 0))
+
+    def test_feed_is_down_unless_every_listener_runs(self):
+        running = mock.Mock(is_alive=mock.Mock(return_value=True))
+        stopped = mock.Mock(is_alive=mock.Mock(return_value=False))
+        self.assertFalse(self._feed_live())
+        with mock.patch.object(Solution, '_listener_threads', [running, running]):
+            self.assertTrue(self._feed_live())
+            with mock.patch.object(Solution, '_listeners_down', {1}):
+                self.assertFalse(self._feed_live())
+        with mock.patch.object(Solution, '_listener_threads', [running, stopped]):
+            self.assertFalse(self._feed_live())
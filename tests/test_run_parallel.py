@@ -0,0 +1,114 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+try:
+    import Solution
+except ImportError:
+    Solution = None
+
+# run_parallel over plain functions and a stub connection whose query runs until it is cancelled, so no database
+# is needed.
+
+
+class _BlockingConnection:
+    # stands for the psycopg2 connection: cancel() ends the query that is running
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class _BlockingConnector:
+    opened = []
+
+    def __init__(self):
+        self.connection = _BlockingConnection()
+        _BlockingConnector.opened.append(self)
+
+    def execute(self, query, printSchema=False):
+        if not self.connection.cancelled.wait(5):
+            raise AssertionError("the query was not cancelled")
+        raise Exception('canceling statement due to user request')
+
+    def close(self):
+        pass
+
+
+def _slow_query():
+    return Solution._fetch_rows("SELECT pg_sleep(5)")
+
+
+@unittest.skipIf(Solution is None, "needs the Business and Utility packages")
+class RunParallelTest(unittest.TestCase):
+    def setUp(self):
+        _BlockingConnector.opened = []
+        patch = mock.patch.object(Solution.Connector, 'DBConnector', _BlockingConnector)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_results_in_call_order(self):
+        def delayed(value, delay):
+            time.sleep(delay)
+            return value
+        calls = [(delayed, 1, 0.06), (delayed, 2, 0.0), (delayed, 3, 0.03), lambda: 4]
+        self.assertEqual(Solution.run_parallel(calls), [1, 2, 3, 4])
+        self.assertEqual(Solution.run_parallel([]), [])
+
+    def test_failed_call_is_marked(self):
+        def fail():
+            raise ValueError('bad')
+        results = Solution.run_parallel([fail, lambda: None])
+        self.assertIsInstance(results[0], Solution.ParallelCallFailed)
+        self.assertEqual(results[0].reason, 'error')
+        self.assertIsInstance(results[0].error, ValueError)
+        # None is an ordinary result
+        self.assertIsNone(results[1])
+
+    def test_timeout_counts_from_the_start_of_each_call(self):
+        # with one worker the other calls wait for the first one, and their timeouts start when they do
+        def sleep(delay):
+            time.sleep(delay)
+            return delay
+        results = Solution.run_parallel([(sleep, 0.5), (sleep, 0.01), (sleep, 0.02)], timeout=0.2, max_workers=1)
+        self.assertEqual(results[0].reason, 'timeout')
+        self.assertEqual(results[1:], [0.01, 0.02])
+
+    def test_timeout_cancels_the_query(self):
+        start = time.monotonic()
+        results = Solution.run_parallel([_slow_query, lambda: 1], timeout=0.1)
+        self.assertEqual(results[0].reason, 'timeout')
+        self.assertEqual(results[1], 1)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(len(_BlockingConnector.opened), 1)
+        self.assertTrue(_BlockingConnector.opened[0].connection.cancelled.wait(1))
+
+    def test_cancel_event(self):
+        cancel = threading.Event()
+        timer = threading.Timer(0.1, cancel.set)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        results = Solution.run_parallel([_slow_query, _slow_query], cancel=cancel)
+        self.assertEqual([result.reason for result in results], ['cancelled', 'cancelled'])
+        self.assertTrue(all(conn.connection.cancelled.wait(1) for conn in _BlockingConnector.opened))
+
+    def test_cancelled_call_cannot_connect_again(self):
+        call = Solution._ParallelCall()
+        call.cancel()
+        Solution._parallel_local.call = call
+        self.addCleanup(setattr, Solution._parallel_local, 'call', None)
+        with self.assertRaises(Solution.DatabaseException.ConnectionInvalid):
+            Solution._new_connection()
+        self.assertEqual(_BlockingConnector.opened, [])
+
+    def test_nested_calls_are_cancelled_with_their_caller(self):
+        def fan_out():
+            return Solution.run_parallel([_slow_query, _slow_query])
+        results = Solution.run_parallel([fan_out], timeout=0.1)
+        self.assertEqual(results[0].reason, 'timeout')
+        deadline = time.monotonic() + 1
+        while len(_BlockingConnector.opened) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(all(conn.connection.cancelled.wait(1) for conn in _BlockingConnector.opened))
@@ -0,0 +1,219 @@
+import io
+import os
+import unittest
+from datetime import datetime
+from decimal import Decimal
+from enum import Enum
+from unittest import mock
+
+try:
+    import psycopg2
+    import Solution
+    from Utility.Exceptions import DatabaseException
+    from Business.Customer import Customer
+    from Business.Order import Order
+    from Business.Dish import Dish
+except ImportError:
+    psycopg2 = None
+
+# a smoke test of the sharded API against the unsharded one. it needs two or more empty PostgreSQL databases with
+# max_prepared_transactions > 0, given as comma separated DSNs, e.g.
+# SOLUTION_SHARD_DSNS="dbname=shard0,dbname=shard1" python -m pytest tests
+# the scenario runs once on the first database alone and once sharded over all of them, and both runs must give
+# the same results.
+SHARD_DSNS = [dsn.strip() for dsn in os.environ.get('SOLUTION_SHARD_DSNS', '').split(',') if dsn.strip()]
+
+_ERROR_CODES = {'23502': 'NOT_NULL_VIOLATION', '23503': 'FOREIGN_KEY_VIOLATION', '23505': 'UNIQUE_VIOLATION',
+                '23514': 'CHECK_VIOLATION'}
+
+
+class _ResultSet:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class _Connector:
+    # DBConnector over a given DSN: autocommitted, with the constraint violations raised as DatabaseException
+    def __init__(self, dsn):
+        try:
+            self.connection = psycopg2.connect(dsn)
+        except psycopg2.Error as e:
+            raise DatabaseException.ConnectionInvalid(str(e))
+        self.connection.autocommit = True
+        self.cursor = self.connection.cursor()
+
+    def execute(self, query, printSchema=False):
+        try:
+            self.cursor.execute(query)
+        except psycopg2.OperationalError as e:
+            raise DatabaseException.ConnectionInvalid(str(e))
+        except psycopg2.Error as e:
+            if e.pgcode in _ERROR_CODES:
+                raise getattr(DatabaseException, _ERROR_CODES[e.pgcode])(str(e))
+            raise
+        rows = self.cursor.fetchall() if self.cursor.description is not None else []
+        return self.cursor.rowcount, _ResultSet(rows)
+
+    def close(self):
+        self.cursor.close()
+        self.connection.close()
+
+
+def _factory(dsn):
+    return lambda: _Connector(dsn)
+
+
+def _plain(value):
+    # business objects compare by their attributes, numbers by value
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    if isinstance(value, (float, Decimal)):
+        return round(float(value), 6)
+    if isinstance(value, (Enum, datetime, str, int, bool)) or value is None:
+        return value
+    return type(value).__name__, sorted((name, _plain(item)) for name, item in vars(value).items())
+
+
+def _rows(dsn, query):
+    conn = _Connector(dsn)
+    try:
+        return conn.execute(query)[1].rows
+    finally:
+        conn.close()
+
+
+CUSTOMERS = [(1, 'Alice Cohen', '0501111111', 'Haifa 1'), (2, 'Bob Levi', '0502222222', 'Tel Aviv 2'),
+             (3, 'Carol Mizrahi', '0503333333', 'Jerusalem 3'), (4, 'Dan Peretz', '0504444444', 'Eilat 4'),
+             (5, 'Eve Biton', '0505555555', 'Akko 5'), (6, 'Frank Amar', '0506666666', 'Ashdod 6')]
+DISHES = [(1, 'Pizza', 50.0, True), (2, 'Pasta', 40.0, True), (3, 'Salad', 30.0, True), (4, 'Soup', 20.0, False),
+          (5, 'Pie', 60.0, True)]
+ORDERS = [(1, datetime(2024, 1, 5, 12, 30)), (2, datetime(2024, 1, 5, 13, 10)), (3, datetime(2024, 2, 10, 9, 0)),
+          (4, datetime(2024, 2, 10, 23, 45)), (5, datetime(2024, 3, 1, 0, 15)), (6, datetime(2024, 3, 1, 18, 0)),
+          (7, datetime(2024, 3, 2, 8, 0)), (8, datetime(2024, 4, 4, 4, 4))]
+LINES = [(1, 1, 2), (1, 2, 1), (2, 3, 4), (3, 1, 1), (3, 5, 2), (4, 2, 3), (5, 1, 1), (5, 3, 2), (6, 2, 2),
+         (6, 4, 1), (7, 5, 1), (8, 3, 3)]
+# with two shards, orders 1, 3, 5 and 7 start on shard 1, so placing them for customers 2 and 4 moves them
+PLACEMENTS = [(2, 1), (3, 2), (1, 3), (4, 5), (2, 6), (6, 7)]
+LIKES = [(1, 1), (1, 2), (1, 3), (2, 1), (2, 2), (2, 3), (2, 5), (3, 1), (3, 2), (3, 3), (3, 4), (4, 1), (4, 5),
+         (5, 2), (6, 3)]
+
+
+def _scenario():
+    # the return values of every call, and the answers of the read API afterwards
+    results = [Solution.create_tables()]
+    results += [Solution.add_customer(Customer(*customer)) for customer in CUSTOMERS]
+    results += [Solution.add_dish(Dish(*dish)) for dish in DISHES]
+    results += [Solution.add_dish(Dish(*DISHES[0])), Solution.add_dish(Dish(9, 'X', 10.0, True))]
+    results += [Solution.add_order(Order(*order)) for order in ORDERS]
+    results += [Solution.add_order(Order(*ORDERS[0]))]
+    results += [Solution.order_contains_dish(*line) for line in LINES[:6]]
+    results += [Solution.customer_placed_order(*placement) for placement in PLACEMENTS]
+    results += [Solution.customer_placed_order(3, 1), Solution.customer_placed_order(9, 4),
+                Solution.customer_placed_order(1, 99)]
+    # the lines added to placed (and moved) orders change the spend summary through the triggers
+    results += [Solution.order_contains_dish(*line) for line in LINES[6:]]
+    results += [Solution.order_contains_dish(1, 4, 1), Solution.order_contains_dish(1, 1, 1)]
+    results += [Solution.update_dish_price(1, 55.0), Solution.update_dish_active_status(4, True),
+                Solution.update_dish_price(99, 10.0)]
+    results += [Solution.order_contains_dish(1, 5, 1), Solution.order_contains_dish(8, 1, 1),
+                Solution.order_does_not_contain_dish(6, 2), Solution.order_does_not_contain_dish(6, 2)]
+    # customer 1 ordered every dish
+    results += [Solution.order_contains_dish(3, dish_id, 1) for dish_id in (2, 3, 4)]
+    results += [Solution.customer_likes_dish(*like) for like in LIKES]
+    results += [Solution.customer_likes_dish(1, 1), Solution.customer_dislike_dish(6, 3),
+                Solution.customer_dislike_dish(6, 3)]
+    results += [Solution.delete_order(7), Solution.delete_order(7), Solution.delete_customer(4)]
+    reads = {
+        'results': results,
+        'customers': [Solution.get_customer(cust_id) for cust_id in range(1, 8)],
+        'orders': [Solution.get_order(order_id) for order_id in range(1, 10)],
+        'dishes': [Solution.get_dish(dish_id) for dish_id in range(1, 7)],
+        'placed_by': [Solution.get_customer_that_placed_order(order_id) for order_id in range(1, 10)],
+        'order_items': [sorted(_plain(Solution.get_all_order_items(order_id))) for order_id in range(1, 10)],
+        'order_prices': [Solution.get_order_total_price(order_id) for order_id in range(1, 10)],
+        'likes': [Solution.get_all_customer_likes(cust_id) for cust_id in range(1, 8)],
+        'max_spent': [Solution.get_max_amount_of_money_cust_spent(cust_id) for cust_id in range(1, 8)],
+        'most_expensive_anonymous': Solution.get_most_expensive_anonymous_order(),
+        'most_liked_is_most_purchased': Solution.is_most_liked_dish_equal_to_most_purchased(),
+        'top_5': Solution.get_customers_ordered_top_5_dishes(),
+        'non_worth': Solution.get_non_worth_price_increase(),
+        'profit_per_month': Solution.get_total_profit_per_month(2024),
+        'recommendations': [Solution.get_potential_dish_recommendations(cust_id) for cust_id in range(1, 7)],
+        'similar': [Solution.get_similar_customers(cust_id, 2) for cust_id in range(1, 7)],
+        'ranked': [Solution.get_ranked_recommendations(cust_id, 3, 2) for cust_id in range(1, 7)],
+        'ranked_by_purchases': [Solution.get_ranked_recommendations(cust_id, 3, 2, True) for cust_id in range(1, 7)],
+        'spend': Solution.get_customer_spend_stats([1, 2, 3, 4, 5, 6, 99]),
+        'all_spend': Solution.get_all_customers_spend_stats(),
+        'profit_by_hour': Solution.get_profit_series(datetime(2024, 1, 5, 12), datetime(2024, 1, 5, 15)),
+        'profit_by_day': Solution.get_profit_series(datetime(2024, 2, 10, 12), datetime(2024, 3, 3), 'day'),
+        'volume_by_day': Solution.get_dish_volume_series(3, datetime(2024, 1, 1), datetime(2024, 4, 5), 'day'),
+        'search_customers': Solution.search_customers('o', 10),
+        'search_dishes': Solution.search_dishes('p', True, 10),
+    }
+    exported = io.StringIO()
+    reads['export_result'] = Solution.export_order_lines(exported)[0]
+    lines = exported.getvalue().splitlines()
+    reads['export'] = [lines[0]] + sorted(lines[1:])
+    return {name: _plain(value) for name, value in reads.items()}
+
+
+@unittest.skipIf(psycopg2 is None or len(SHARD_DSNS) < 2, "needs psycopg2 and SOLUTION_SHARD_DSNS with 2+ DSNs")
+class ShardingSmokeTest(unittest.TestCase):
+    def setUp(self):
+        self._drop_all()
+        self.addCleanup(self._drop_all)
+
+    def _drop_all(self):
+        Solution.clear_shards()
+        for dsn in SHARD_DSNS:
+            with mock.patch.object(Solution.Connector, 'DBConnector', _factory(dsn)):
+                Solution.drop_tables()
+        Solution.clear_query_cache()
+
+    def _assert_summaries(self, dsn):
+        # the trigger-maintained tables match what they summarize
+        spend = _rows(dsn, "SELECT cust_id, COUNT(*), SUM(total), MAX(total) FROM "
+                           "(SELECT CPO.cust_id, COALESCE(SUM(DIO.amount * DIO.price), 0) AS total "
+                           "FROM CUSTOMERS_PLACE_ORDERS CPO "
+                           "LEFT OUTER JOIN DISHES_IN_ORDERS DIO ON CPO.order_id = DIO.order_id "
+                           "GROUP BY CPO.cust_id, CPO.order_id) AS T GROUP BY cust_id ORDER BY cust_id")
+        summary = _rows(dsn, "SELECT cust_id, order_count, total_spent, max_order_price "
+                             "FROM CUSTOMERS_SPEND_SUMMARY WHERE order_count > 0 ORDER BY cust_id")
+        self.assertEqual(_plain(summary), _plain(spend))
+        self.assertEqual(_rows(dsn, "SELECT cust_id FROM CUSTOMERS_SPEND_SUMMARY WHERE order_count = 0 "
+                                    "AND (total_spent <> 0 OR max_order_price <> 0)"), [])
+        sales = _rows(dsn, "SELECT date_trunc('hour', O.date), DIO.dish_id, SUM(DIO.amount), "
+                           "SUM(DIO.amount * DIO.price) FROM DISHES_IN_ORDERS DIO "
+                           "INNER JOIN ORDERS O ON DIO.order_id = O.order_id GROUP BY 1, 2 ORDER BY 1, 2")
+        self.assertEqual(_plain(_rows(dsn, "SELECT sales_hour, dish_id, amount, profit FROM SALES_PER_HOUR "
+                                           "ORDER BY sales_hour, dish_id")), _plain(sales))
+
+    def test_sharded_results_match_unsharded(self):
+        with mock.patch.object(Solution.Connector, 'DBConnector', _factory(SHARD_DSNS[0])):
+            unsharded = _scenario()
+            self._assert_summaries(SHARD_DSNS[0])
+            Solution.drop_tables()
+        Solution.clear_query_cache()
+
+        Solution.configure_shards([_factory(dsn) for dsn in SHARD_DSNS])
+        sharded = _scenario()
+        for name in unsharded:
+            self.assertEqual(sharded[name], unsharded[name], name)
+        for dsn in SHARD_DSNS:
+            self._assert_summaries(dsn)
+
+        # customers and their orders live on the shard of the customer, the menu on every shard
+        shards = len(SHARD_DSNS)
+        for shard, dsn in enumerate(SHARD_DSNS):
+            self.assertTrue(all(cust_id % shards == shard for cust_id, in _rows(dsn, "SELECT cust_id FROM CUSTOMERS")))
+            self.assertTrue(all(cust_id % shards == shard
+                                for cust_id, in _rows(dsn, "SELECT cust_id FROM CUSTOMERS_PLACE_ORDERS")))
+            self.assertEqual(_plain(_rows(dsn, "SELECT * FROM DISHES ORDER BY dish_id")),
+                             _plain(_rows(SHARD_DSNS[0], "SELECT * FROM DISHES ORDER BY dish_id")))
+            self.assertEqual(_rows(dsn, "SELECT gid FROM pg_prepared_xacts"), [])
+        order_ids = [order_id for dsn in SHARD_DSNS for order_id, in _rows(dsn, "SELECT order_id FROM ORDERS")]
+        self.assertEqual(sorted(order_ids), [1, 2, 3, 4, 5, 6, 8])
+
+
+if __name__ == '__main__':
+    unittest.main()